@@ -0,0 +1,172 @@
+"""
+Count messages by fields instead of printing them (greplog --count-by).
+
+Counts are kept in a TopCounter, which is exact as long as there are few
+distinct keys. With many (IPs, paths, parameter values) it turns into a
+Space-Saving heavy hitter sketch: memory stays bounded, the most frequent
+keys are still found, and each count is reported with its largest possible
+overestimate.
+
+"""
+import itertools
+
+__author__ = 'anna'
+
+CAPACITY = 10000
+MISSING = '-'
+
+
+class TopCounter(object):
+    """
+    Space-Saving counter for the most frequent keys, holding at most 2 * capacity keys.
+
+    When it's full, only the 'capacity' largest counts are kept. A key seen
+    afterwards starts from the largest count that was thrown away, so counts
+    are never underestimated, and are overestimated by at most 'error'.
+
+    >>> counter = TopCounter(2)
+    >>> for key in 'aaaabbbcdd':
+    ...     counter.add(key)
+    >>> counter.top(2)
+    [('a', 4, 0), ('b', 3, 0)]
+    >>> counter.add('e')
+    >>> counter.add('d')
+    >>> counter.top(3)
+    [('a', 4, 0), ('b', 3, 0), ('d', 3, 2)]
+    """
+
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.counts = dict()
+        self.errors = dict()
+        self.floor = 0
+
+    def add(self, key):
+        if key in self.counts:
+            self.counts[key] += 1
+            return
+        self.counts[key] = self.floor + 1
+        self.errors[key] = self.floor
+        if len(self.counts) > 2 * self.capacity:
+            self.prune()
+
+    def prune(self):
+        """
+        Keep only the 'capacity' largest counts.
+        """
+        ranked = sorted(self.counts.iteritems(), key=lambda item: item[1], reverse=True)
+        for key, count in ranked[self.capacity:]:
+            self.floor = max(self.floor, count)
+            del self.counts[key]
+            del self.errors[key]
+
+    def merge(self, other):
+        """
+        Add the counts from another TopCounter, e.g. from another process.
+        A key missing from one of the counters may have been counted up to its 'floor' times there.
+        """
+        for key in self.counts:
+            if key not in other.counts:
+                self.counts[key] += other.floor
+                self.errors[key] += other.floor
+        for key, count in other.counts.iteritems():
+            if key in self.counts:
+                self.counts[key] += count
+                self.errors[key] += other.errors[key]
+            else:
+                self.counts[key] = self.floor + count
+                self.errors[key] = self.floor + other.errors[key]
+        self.floor += other.floor
+        if len(self.counts) > 2 * self.capacity:
+            self.prune()
+
+    def top(self, n):
+        """
+        :return: list of (key, count, error) for the 'n' largest counts, largest first
+        """
+        ranked = sorted(self.counts.iteritems(), key=lambda item: (-item[1], item[0]))
+        return [(key, count, self.errors[key]) for key, count in ranked[:n]]
+
+    def exact(self):
+        return self.floor == 0
+
+
+def field_values(spec):
+    """
+    :param spec: ip, path, method, status, header:NAME or param:NAME
+    :return: Function from a message to the list of values of the field
+    """
+    if spec == 'ip':
+        return lambda message: [message.start().get_ip()]
+    if spec == 'path':
+        return lambda message: [message.request_headers().get_path()]
+    if spec == 'method':
+        return lambda message: [str(message.method())]
+    if spec == 'status':
+        return lambda message: [str(message.response_headers().get_response_code())]
+    kind, _, name = spec.partition(':')
+    if kind == 'header' and name:
+        name = name.lower()
+
+        def header_values(message):
+            return [value for header, values in message.request_headers().get_headers().iteritems()
+                    if header.lower() == name for value in values]
+
+        return header_values
+    if kind == 'param' and name:
+        def parameter_values(message):
+            values = message.parameters().param.get(name, [])
+            if not isinstance(values, list):  # Parameters from JSON content aren't lists
+                values = [values]
+            return [value if isinstance(value, basestring) else str(value) for value in values]
+
+        return parameter_values
+    raise ValueError('Unknown field ' + spec)
+
+
+class Aggregate(object):
+    """
+    Count messages by the fields in 'specs'. Messages with several values for a
+    field (headers, parameters) are counted once for every combination.
+    """
+
+    def __init__(self, specs, capacity=CAPACITY):
+        self.specs = specs
+        self.fields = [field_values(spec) for spec in specs]
+        self.counter = TopCounter(capacity)
+        self.messages = 0
+
+    def add(self, message):
+        self.messages += 1
+        values = [field(message) or [MISSING] for field in self.fields]
+        for key in itertools.product(*values):
+            self.counter.add(key)
+
+    def get_counters(self):
+        return self.messages, self.counter
+
+    def add_counters(self, counters):
+        messages, counter = counters
+        self.messages += messages
+        self.counter.merge(counter)
+
+    def report(self, stream, n):
+        """
+        Write a table with the 'n' most frequent keys to 'stream'.
+        """
+        rows = self.counter.top(n)
+        exact = self.counter.exact()
+        columns = ['count'] + ([] if exact else ['+/-']) + self.specs
+        table = [[str(count)] + ([] if exact else [str(error)]) + [value or MISSING for value in key]
+                 for key, count, error in rows]
+        numbers = len(columns) - len(self.specs)
+        widths = [max(len(row[i]) for row in [columns] + table) for i in xrange(len(columns))]
+        for row in [columns] + table:
+            cells = [cell.rjust(width) if i < numbers else cell.ljust(width)
+                     for i, (cell, width) in enumerate(zip(row, widths))]
+            stream.write('  '.join(cells).rstrip() + '\n')
+        if exact:
+            stream.write('\n{0:d} messages, {1:d} distinct keys\n'.format(self.messages, len(self.counter.counts)))
+        else:
+            stream.write('\n{0:d} messages. Counts are approximate, and may be too high by up to +/-\n'.format(
+                self.messages))
@@ -0,0 +1,213 @@
+"""
+Audit logs written with SecAuditLogType Concurrent.
+
+ModSecurity then stores every transaction in a file of its own under
+SecAuditLogStorageDir:
+
+    <root>/YYYYMMDD/YYYYMMDD-HHMM/YYYYMMDD-HHMMSS-<unique id>
+
+and appends one line per transaction to an index file (SecAuditLog), ending
+with the path of the transaction file relative to the root. The times in
+directory and file names are the local time of the request, the same as
+in Section A, so whole directories can be skipped by time without being read:
+by time of day for --timestamp/--timestamp-between, and by date and time for
+--since/--until.
+
+If the index file is available (ROOT/index, or given explicitly), the list of
+transactions is taken from it instead of walking the tree.
+
+"""
+import datetime
+import os
+import re
+from timestamps import SECONDS_PER_DAY, days_from_civil
+
+__author__ = 'anna'
+
+INDEX_NAME = 'index'
+
+DAY_PATTERN = re.compile(r'^\d{8}$')
+MINUTE_PATTERN = re.compile(r'^\d{8}-(\d{2})(\d{2})$')
+FILE_PATTERN = re.compile(r'^\d{8}-(\d{2})(\d{2})(\d{2})-')
+# Names are in local time, so a point in time with a timezone can be this far off
+MAX_UTC_OFFSET = 14 * 3600
+NAME_TIME_PATTERN = re.compile(r'^(\d{4})(\d{2})(\d{2})(?:-(\d{2})(\d{2})(\d{2})?)?(?:-|$)')
+INDEX_TIME_PATTERN = re.compile(r'\[[^:\]]+:(\d{2}):(\d{2}):(\d{2})[^\]]*\]')
+
+
+def is_audit_dir(path):
+    return path != '-' and os.path.isdir(path)
+
+
+def output_name(root):
+    """
+    :return: 'root' without trailing slashes, to name files written for the whole directory
+    """
+    return os.path.normpath(root)
+
+
+def parse_index_line(line):
+    """
+    Find the transaction file and the time of day in a line of the index file.
+    :return: (relative path, datetime.time or None), or None if the line isn't an index entry
+
+    >>> parse_index_line('web1 10.0.0.1 - - [16/Oct/2026:10:15:30 +0200] "GET / HTTP/1.1" 200 12 "-" "curl" '
+    ...                  'V1AAAA "-" /20261016/20261016-1015/20261016-101530-V1AAAA 0 830 md5:0')
+    ('/20261016/20261016-1015/20261016-101530-V1AAAA', datetime.time(10, 15, 30))
+    >>> parse_index_line('garbage') is None
+    True
+    """
+    fields = line.rsplit('"', 1)[-1].split()
+    if not fields or not fields[0].startswith('/'):
+        return None
+    result = INDEX_TIME_PATTERN.search(line)
+    timestamp = None
+    if result:
+        timestamp = datetime.time(*[int(x) for x in result.groups()])
+    return fields[0], timestamp
+
+
+def minute_overlaps(name, first, last):
+    """
+    :return: False if the minute directory 'name' can't hold anything between 'first' and 'last'
+
+    >>> minute_overlaps('20261016-1015', datetime.time(10, 15, 40), datetime.time(11, 0))
+    True
+    >>> minute_overlaps('20261016-1015', datetime.time(10, 16), datetime.time(11, 0))
+    False
+    """
+    result = MINUTE_PATTERN.match(name)
+    if not result or first is None:
+        return True
+    hour, minute = [int(x) for x in result.groups()]
+    return (datetime.time(hour, minute, 59) >= first and
+            datetime.time(hour, minute) <= last)
+
+
+def file_in_window(name, first, last):
+    """
+    :return: False if the transaction file 'name' was logged outside 'first' and 'last'
+    """
+    result = FILE_PATTERN.match(name)
+    if not result or first is None:
+        return True
+    return first <= datetime.time(*[int(x) for x in result.groups()]) <= last
+
+
+def name_span(name):
+    """
+    :return: (first, last) second that the day directory, minute directory or transaction file 'name'
+    can hold, in seconds since epoch as if the log was written in UTC, or None if 'name' has no time
+
+    >>> name_span('20261016') == (1792108800, 1792108800 + 86399)
+    True
+    >>> name_span('20261016-1015') == (1792108800 + 36900, 1792108800 + 36959)
+    True
+    >>> name_span('20261016-101530-V1AAAA') == (1792108800 + 36930, 1792108800 + 36930)
+    True
+    >>> name_span('lost+found') is None
+    True
+    """
+    result = NAME_TIME_PATTERN.match(name)
+    if not result:
+        return None
+    year, month, day, hour, minute, second = result.groups()
+    start = days_from_civil(int(year), int(month), int(day)) * SECONDS_PER_DAY
+    if hour is None:
+        return start, start + SECONDS_PER_DAY - 1
+    start += int(hour) * 3600 + int(minute) * 60
+    if second is None:
+        return start, start + 59
+    start += int(second)
+    return start, start
+
+
+def in_range(name, since, until):
+    """
+    :param since: (seconds since epoch, has a timezone) from timestamps.parse_point, or None
+    :param until: Same as 'since'
+    :return: False if 'name' can't hold anything logged between 'since' and 'until'
+
+    >>> in_range('20261016-1015', (1792108800 + 36960, False), None)
+    False
+    >>> in_range('20261016-1015', (1792108800 + 36960, True), None)
+    True
+    >>> in_range('20261015', None, (1792108800, False))
+    True
+    >>> in_range('20261017', None, (1792108800 + 86399, False))
+    False
+    """
+    if since is None and until is None:
+        return True
+    span = name_span(name)
+    if span is None:
+        return True
+    first, last = span
+    if since is not None and last + (MAX_UTC_OFFSET if since[1] else 0) < since[0]:
+        return False
+    if until is not None and first - (MAX_UTC_OFFSET if until[1] else 0) > until[0]:
+        return False
+    return True
+
+
+def walk(root, first=None, last=None, since=None, until=None):
+    """
+    Yield the transaction files under 'root', skipping day and minute directories outside 'first' and 'last',
+    and 'since' and 'until'.
+    """
+    for day in os.listdir(root):
+        day_path = os.path.join(root, day)
+        if not DAY_PATTERN.match(day) or not in_range(day, since, until) or not os.path.isdir(day_path):
+            continue
+        for minute in os.listdir(day_path):
+            if not minute_overlaps(minute, first, last) or not in_range(minute, since, until):
+                continue
+            minute_path = os.path.join(day_path, minute)
+            if not os.path.isdir(minute_path):
+                continue
+            for name in os.listdir(minute_path):
+                if file_in_window(name, first, last) and in_range(name, since, until):
+                    yield os.path.join(minute_path, name)
+
+
+def read_index(root, index, first=None, last=None, since=None, until=None):
+    """
+    Yield the transaction files listed in the index file 'index', logged between 'first' and 'last',
+    and 'since' and 'until'.
+    Files that have been removed since are left out.
+    """
+    with open(index, 'rb') as f:
+        for line in f:
+            entry = parse_index_line(line)
+            if entry is None:
+                continue
+            path, timestamp = entry
+            if first is not None and timestamp is not None and not first <= timestamp <= last:
+                continue
+            if not in_range(os.path.basename(path), since, until):
+                continue
+            path = os.path.join(root, path.lstrip('/'))
+            if os.path.isfile(path):
+                yield path
+
+
+def transactions(root, index=None, first=None, last=None, since=None, until=None):
+    """
+    List the transaction files of the concurrent audit log in 'root', in timestamp order.
+
+    :param index: Index file. ROOT/index is used if it exists.
+    :param first: datetime.time. Leave out transactions logged earlier in the day.
+    :param last: datetime.time. Leave out transactions logged later in the day.
+    :param since: (seconds since epoch, has a timezone) from timestamps.parse_point. Leave out
+    transactions logged earlier.
+    :param until: Same as 'since'. Leave out transactions logged later.
+    :return: list of paths
+    """
+    if index is None and os.path.isfile(os.path.join(root, INDEX_NAME)):
+        index = os.path.join(root, INDEX_NAME)
+    if index is not None:
+        paths = set(read_index(root, index, first, last, since, until))
+    else:
+        paths = walk(root, first, last, since, until)
+    # File names start with the date and time, so sorting on them sorts on time
+    return sorted(paths, key=lambda path: (os.path.basename(path), path))
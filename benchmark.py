@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for parsing, filtering and formatting, greplog and jsonlog.
+
+    python benchmark.py                                 # on a generated log, against BASELINE
+    python benchmark.py modsec_audit.log
+    python benchmark.py --save-baseline baseline.json
+    python benchmark.py --baseline baseline.json        # exit status 1 on regressions
+
+BASELINE holds the results on the generated log of DEFAULT_MESSAGES messages,
+made with 'python benchmark.py --save-baseline benchmark_baseline.json'. Runs
+on that log are compared with it unless --baseline says otherwise. Throughput
+depends on the machine, so save a baseline of your own before changing code.
+
+Each benchmark runs REPEAT times in a process of its own, and the fastest run
+is reported together with the peak RSS of that process. Throughput is
+measured in CPU time, which is less noisy than wall clock time on a busy
+machine, except for benchmarks that use several processes.
+
+"""
+import argparse
+import gc
+import json
+import jsonlog
+import logreader
+import multiprocessing
+import os
+import parallel
+import resource
+import sys
+import tempfile
+import time
+import traceback
+import types
+from generate import Generator
+from greplog import GrepLog, ColorMessage
+from jsonlog import JsonLog
+from mod_security import IGNORE, LogParts, Message, ModSecurityLog
+from utils import split_re
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2 needs pytracemalloc and a patched interpreter
+    tracemalloc = None
+
+__author__ = 'anna'
+
+QUERIES = [
+    ['--with-headers', 'Language=en'],
+    ['--with-parameters', 'user=a'],
+    ['--with-ip', '10.0.1'],
+    ['--without-ip', '10.0.1', '10.0.2'],
+    ['--with-headers', 'Agent=Mozilla', '--with-parameters', 'id=[0-9]'],
+]
+
+SPLIT_PATTERNS = ['id', 'user', '[0-9]+']
+
+REPEAT = 3
+MB = 1024.0 * 1024
+DEFAULT_MESSAGES = 20000
+DEFAULT_TOLERANCE = 0.2
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+RSS_UNIT = 'MB peak RSS'
+# os.times counts in clock ticks, so a short run can take no measurable time at all
+MIN_SECONDS = 0.01
+TRACED_UNIT = 'MB peak traced'
+HELD_UNIT = 'KB peak held'
+MEAN_HELD_UNIT = 'KB held per message'
+# Shared by all messages, not held by any one of them
+SHARED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType,
+                bool, types.NoneType)
+
+
+def cpu_time():
+    """
+    User + system CPU seconds used by this process. Less noisy than wall clock time on a busy machine.
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+def cpu_seconds(start):
+    """
+    :return: CPU seconds since 'start', at least MIN_SECONDS
+    """
+    return max(cpu_time() - start, MIN_SECONDS)
+
+
+def peak_rss():
+    """
+    :return: Largest resident set size of this process so far, in MB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def lower_is_better(unit):
+    return unit in (RSS_UNIT, TRACED_UNIT, HELD_UNIT, MEAN_HELD_UNIT)
+
+
+def score(metrics):
+    unit, value = metrics[0]
+    return -value if lower_is_better(unit) else value
+
+
+def best_of(function, *args):
+    """
+    Run 'function' REPEAT times. The fastest run is the least disturbed by other processes.
+    :return: The list of (unit, value) of the best run, judged by the first value
+    """
+    return max((function(*args) for _ in xrange(REPEAT)), key=score)
+
+
+def measure(connection, function, args):
+    """
+    Send (list of (unit, value), peak RSS in MB) to 'connection', or (None, traceback) if the benchmark failed.
+    """
+    try:
+        result = best_of(function, *args), peak_rss()
+    except Exception:
+        result = None, traceback.format_exc()
+    connection.send(result)
+    connection.close()
+
+
+def isolated(function, *args):
+    """
+    Run best_of(function, *args) in a new process, so the peak RSS belongs to this benchmark alone.
+    :return: (list of (unit, value), peak RSS in MB)
+    """
+    receiver, sender = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=measure, args=(sender, function, args))
+    process.start()
+    # Only the child holds the sending end now, so recv fails instead of waiting if the child dies
+    sender.close()
+    try:
+        metrics, extra = receiver.recv()
+    except EOFError:
+        process.join()
+        raise RuntimeError('{0:s} died with exit code {1:d}'.format(function.__name__, process.exitcode))
+    process.join()
+    if metrics is None:
+        raise RuntimeError('{0:s} failed:\n{1:s}'.format(function.__name__, extra))
+    return metrics, extra
+
+
+def read_lines(filename):
+    with open(filename) as f:
+        return [line.strip() for line in f]
+
+
+def parse_messages(filename, lines, query):
+    """
+    Parse all messages in 'lines' with the filters in 'query'
+    :return: (GrepLog, list of parsed messages)
+    """
+    greplog = GrepLog([filename] + query, reuse_messages=False)
+    messages = list()
+
+    def keep(message):
+        messages.append(message)
+
+    for line_count, line in enumerate(lines, 1):
+        greplog.parse_line(line, line_count, callback=keep)
+    return greplog, messages
+
+
+def bench_parse_line(filename):
+    """
+    :return: Lines, messages and MB per second for ModSecurityLog.parse_line, without filters
+    """
+    lines = read_lines(filename)
+    log = ModSecurityLog(None, message_class=Message, reuse_messages=True)
+    messages = [0]
+
+    def count(message):
+        messages[0] += 1
+
+    start = cpu_time()
+    for line_count, line in enumerate(lines, 1):
+        log.parse_line(line, line_count, callback=count)
+    seconds = cpu_seconds(start)
+    return [('lines/s', len(lines) / seconds), ('msg/s', messages[0] / seconds),
+            ('MB/s', os.path.getsize(filename) / MB / seconds)]
+
+
+def bench_show(filename, query, rounds=5):
+    """
+    :return: Messages per second for ColorMessage.show()
+    """
+    _, messages = parse_messages(filename, read_lines(filename), query)
+    start = cpu_time()
+    for _ in xrange(rounds):
+        for message in messages:
+            message.filters_passed = None
+            message.show()
+    return [('msg/s', rounds * len(messages) / cpu_seconds(start))]
+
+
+def bench_split_re(filename, rounds=5):
+    """
+    :return: Calls per second for split_re on the paths and query strings of the log
+    """
+    _, messages = parse_messages(filename, read_lines(filename), [])
+    texts = list()
+    for message in messages:
+        texts.append(message.request_headers().get_path())
+        texts.append(message.request_headers().get_query_string())
+    start = cpu_time()
+    for _ in xrange(rounds):
+        for text in texts:
+            split_re(text, SPLIT_PATTERNS)
+    return [('calls/s', rounds * len(texts) / cpu_seconds(start))]
+
+
+class NullStream(object):
+    def write(self, text):
+        pass
+
+
+def bench_greplog(filename, query):
+    """
+    :return: Messages and MB per second for reading 'filename' with logreader, parsing, filtering and formatting
+    """
+    greplog = GrepLog([filename] + query)
+    handler = ColorMessage.message_handler_factory(NullStream())
+    start = cpu_time()
+    logreader.parse_file(greplog, filename, handler, line_numbers=False)
+    seconds = cpu_seconds(start)
+    return [('msg/s', greplog.args.filters.evaluated / seconds), ('MB/s', os.path.getsize(filename) / MB / seconds)]
+
+
+def bench_allocations(filename, query):
+    """
+    :return: Peak MB allocated by Python while greplog reads, parses, filters and formats 'filename'
+    """
+    greplog = GrepLog([filename] + query)
+    handler = ColorMessage.message_handler_factory(NullStream())
+    tracemalloc.start()
+    try:
+        logreader.parse_file(greplog, filename, handler, line_numbers=False)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return [(TRACED_UNIT, peak / MB)]
+
+
+def held_bytes(obj, shared):
+    """
+    :param shared: Objects that 'obj' refers to but doesn't own, e.g. the command line arguments
+    :return: Bytes held by 'obj' and everything it refers to, by sys.getsizeof
+    """
+    seen = set(id(x) for x in shared)
+    size = 0
+    pending = [obj]
+    while pending:
+        current = pending.pop()
+        if id(current) in seen or isinstance(current, SHARED_TYPES):
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        pending.extend(gc.get_referents(current))
+    return size
+
+
+def bench_message_size(filename, query):
+    """
+    Works without tracemalloc, e.g. on Python 2.
+    :return: Peak and mean KB held by a message, with its parts, parameters and raw lines, once greplog
+    has filtered and formatted it
+    """
+    greplog = GrepLog([filename] + query)
+    handler = ColorMessage.message_handler_factory(NullStream())
+    shared = [greplog, greplog.args, IGNORE] + list(LogParts)
+    sizes = list()
+
+    def handle(message):
+        handler(message)
+        sizes.append(held_bytes(message, shared))
+
+    logreader.parse_file(greplog, filename, handle, line_numbers=False)
+    return [(HELD_UNIT, max(sizes) / 1024.0), (MEAN_HELD_UNIT, sum(sizes) / 1024.0 / len(sizes))]
+
+
+class CountingStream(object):
+    """
+    Count the records written, one per line.
+    """
+
+    def __init__(self):
+        self.records = 0
+
+    def write(self, text):
+        self.records += text.count('\n')
+
+
+def bench_jsonlog(filename):
+    """
+    :return: MB and messages per second for converting 'filename' to JSON in this process
+    """
+    log = JsonLog([filename])
+    stream = CountingStream()
+    start = cpu_time()
+    jsonlog.convert(log, [filename], stream)
+    seconds = cpu_seconds(start)
+    return [('MB/s', os.path.getsize(filename) / MB / seconds), ('msg/s', stream.records / seconds)]
+
+
+def bench_jsonlog_parallel(filename, jobs):
+    """
+    :return: MB and messages per second for converting 'filename' to JSON with 'jobs' processes.
+    Measured in wall clock time, since the work is done in other processes.
+    """
+    stream = CountingStream()
+    start = time.time()
+    for _, output, _ in parallel.scan(JsonLog, [filename], [filename], jobs):
+        stream.write(output)
+    seconds = max(time.time() - start, MIN_SECONDS)
+    return [('MB/s', os.path.getsize(filename) / MB / seconds), ('msg/s', stream.records / seconds)]
+
+
+def benchmarks(filename):
+    """
+    Yield (name, query, function, arguments) for all benchmarks
+    """
+    yield 'parse', [], bench_parse_line, (filename,)
+    yield 'split_re', SPLIT_PATTERNS, bench_split_re, (filename,)
+    for query in QUERIES:
+        yield 'show', query, bench_show, (filename, query)
+    for query in QUERIES:
+        yield 'greplog', query, bench_greplog, (filename, query)
+    for query in [[], ['--show-raw-content']]:
+        yield 'memory', query, bench_message_size, (filename, query)
+        if tracemalloc is not None:
+            yield 'memory', query, bench_allocations, (filename, query)
+    yield 'jsonlog', ['(' + jsonlog.ENCODER + ')'], bench_jsonlog, (filename,)
+    jobs = multiprocessing.cpu_count()
+    yield 'jsonlog', ['(' + jsonlog.ENCODER + ')', '--jobs', str(jobs)], bench_jsonlog_parallel, (filename, jobs)
+
+
+def key(name, query, unit):
+    return ' '.join([name] + query + ['[' + unit + ']'])
+
+
+def regressed(unit, value, baseline, tolerance):
+    """
+    :return: True if 'value' is worse than 'baseline' by more than 'tolerance' (a fraction)
+    """
+    if lower_is_better(unit):
+        return value > baseline * (1 + tolerance)
+    return value < baseline * (1 - tolerance)
+
+
+def report(name, query, value, unit, baseline=None):
+    line = '{name:<10s} {query:<60s} {value:>12.1f} {unit:s}'.format(name=name, query=' '.join(query),
+                                                                    value=value, unit=unit)
+    if baseline:
+        line += ' ({0:+.0f}%)'.format(100.0 * (value - baseline) / baseline)
+    print line
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(description='Benchmark parsing, filtering, greplog and jsonlog')
+    parser.add_argument('file', help='Log file. A log with MESSAGES messages is generated if it is left out',
+                        nargs='?')
+    parser.add_argument('--messages', help='Size of the generated log (default %d)' % DEFAULT_MESSAGES,
+                        type=int, default=DEFAULT_MESSAGES)
+    parser.add_argument('--baseline', help='Compare with the results in BASELINE, and fail on regressions. '
+                                           'Runs on the generated log are compared with %s by default, '
+                                           '\'\' for none' % os.path.basename(BASELINE))
+    parser.add_argument('--save-baseline', help='Save the results to SAVE_BASELINE', metavar='SAVE_BASELINE')
+    parser.add_argument('--tolerance', help='Allowed slowdown or memory growth against the baseline, as a fraction '
+                                            '(default %.1f)' % DEFAULT_TOLERANCE,
+                        type=float, default=DEFAULT_TOLERANCE)
+    return parser
+
+
+def main(args):
+    args = get_arg_parser().parse_args(args)
+    filename = args.file
+    if filename is None:
+        with tempfile.NamedTemporaryFile(suffix='.log', delete=False) as f:
+            Generator().write(f, args.messages)
+        filename = f.name
+    if (args.baseline is None and args.file is None and args.messages == DEFAULT_MESSAGES and
+            os.path.isfile(BASELINE)):
+        args.baseline = BASELINE
+    baseline = dict()
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = dict()
+    regressions = list()
+    try:
+        for name, query, function, arguments in benchmarks(filename):
+            metrics, rss = isolated(function, *arguments)
+            for unit, value in metrics + [(RSS_UNIT, rss)]:
+                k = key(name, query, unit)
+                results[k] = value
+                report(name, query, value, unit, baseline.get(k))
+                if k in baseline and regressed(unit, value, baseline[k], args.tolerance):
+                    regressions.append(k)
+    finally:
+        if args.file is None:
+            os.remove(filename)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    for k in regressions:
+        sys.stderr.write('REGRESSION: {0:s}: {1:.1f}, baseline {2:.1f}\n'.format(k, results[k], baseline[k]))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,224 @@
+"""
+Sidecar inverted index over the fields greplog filters on.
+
+The index is stored next to the log as <log>.fidx. For each field (client
+IP, request method, request header names and parameter names) it maps every value seen to the list of messages that have it. Later
+searches look up the values that can match the query, intersect the lists,
+and only parse those messages.
+
+Message numbers in each list are delta encoded as varints, and the whole
+index is serialized with marshal. Request bodies are parsed in full, whatever
+--max-body-size and --max-parameters are, so the index holds every parameter
+name a search could find.
+
+"""
+import marshal
+import os
+import struct
+import logreader
+from mod_security import Message, ModSecurityLog
+
+__author__ = 'anna'
+
+EXTENSION = '.fidx'
+FIELDS = ('ip', 'method', 'header', 'param')
+
+HEADER = struct.Struct('<8sQdQ')
+MAGIC = 'MSFIDX02'
+
+
+def index_filename(filename):
+    return filename + EXTENSION
+
+
+def file_signature(filename):
+    """
+    :return: (size, mtime) of 'filename'. The index is stale if either changes.
+    """
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime
+
+
+def encode_varints(numbers):
+    """
+    Encode increasing non-negative integers as deltas, 7 bits per byte.
+
+    >>> encode_varints([1, 2, 300])
+    '\\x01\\x01\\xaa\\x02'
+    >>> decode_varints(encode_varints([0, 5, 1000000]))
+    [0, 5, 1000000]
+    """
+    out = bytearray()
+    previous = 0
+    for number in numbers:
+        delta = number - previous
+        previous = number
+        while delta >= 0x80:
+            out.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return str(out)
+
+
+def decode_varints(data):
+    numbers = list()
+    number = 0
+    delta = 0
+    shift = 0
+    for byte in bytearray(data):
+        delta |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            number += delta
+            numbers.append(number)
+            delta = 0
+            shift = 0
+    return numbers
+
+
+class IndexMessage(Message):
+    """
+    Message parsed for the index, with no limit on the request body.
+    """
+    __slots__ = ()
+
+    def body_limits(self):
+        return 0, 0
+
+
+class FieldIndex(object):
+    def __init__(self, filename, offsets, lines, postings, size, mtime, end):
+        """
+        :param offsets: Byte offset of each message
+        :param lines: Line number of each message
+        :param postings: Dictionary field -> value -> encoded message numbers
+        :param size: File size when the index was built
+        :param mtime: File modification time when the index was built
+        :param end: Offset of the end of the (uncompressed) data
+        """
+        self.filename = filename
+        self.offsets = offsets
+        self.lines = lines
+        self.postings = postings
+        self.size = size
+        self.mtime = mtime
+        self.end = end
+
+    @staticmethod
+    def message_fields(message):
+        """
+        Yield (field, value) for everything indexed about 'message'
+        """
+        yield 'ip', message.start().get_ip()
+        request = message.request_headers()
+        yield 'method', str(request.get_method())
+        for name in request.get_headers().param:
+            yield 'header', name
+        for name in request.get_parameters().param:
+            yield 'param', name
+        for name in message.content().get_parameters().param:
+            yield 'param', name
+
+    @classmethod
+    def build(cls, filename):
+        """
+        Parse all messages in 'filename'.
+        """
+        size, mtime = file_signature(filename)
+        offsets = list()
+        lines = list()
+        postings = dict((field, dict()) for field in FIELDS)
+        log = ModSecurityLog(None, message_class=IndexMessage, reuse_messages=True)
+        state = {'offset': 0, 'message_offset': 0}
+
+        def add(message):
+            number = len(offsets)
+            offsets.append(state['message_offset'])
+            lines.append(message.line_count)
+            for field, value in cls.message_fields(message):
+                if value is not None:
+                    numbers = postings[field].setdefault(value, [])
+                    if not numbers or numbers[-1] != number:
+                        numbers.append(number)
+
+        for line_count, line in enumerate(logreader.read_lines(filename), 1):
+            stripped = line.strip()
+            result = ModSecurityLog.DELIMITER_PATTERN.match(stripped)
+            if result and result.group(2) == 'A':
+                state['message_offset'] = state['offset']
+            log.parse_line(stripped, line_count, callback=add)
+            state['offset'] += len(line)
+
+        for values in postings.itervalues():
+            for value, numbers in values.iteritems():
+                values[value] = encode_varints(numbers)
+        return cls(filename, offsets, lines, postings, size, mtime, state['offset'])
+
+    @classmethod
+    def load(cls, filename):
+        """
+        :return: The index for 'filename', or None if there is none or it's stale
+        """
+        try:
+            with open(index_filename(filename), 'rb') as f:
+                magic, size, mtime, end = HEADER.unpack(f.read(HEADER.size))
+                if magic != MAGIC or (size, mtime) != file_signature(filename):
+                    return None
+                offsets, lines, postings = marshal.load(f)
+        except (IOError, OSError, EOFError, ValueError, TypeError, struct.error):
+            return None
+        return cls(filename, decode_varints(offsets), decode_varints(lines), postings, size, mtime, end)
+
+    @classmethod
+    def get(cls, filename):
+        """
+        Load the index for 'filename', or build and save it if it's missing or stale.
+        """
+        index = cls.load(filename)
+        if index is None:
+            index = cls.build(filename)
+            index.save()
+        return index
+
+    def save(self):
+        """
+        Write the index next to the log. Does nothing if that isn't possible.
+        """
+        try:
+            with open(index_filename(self.filename), 'wb') as f:
+                f.write(HEADER.pack(MAGIC, self.size, self.mtime, self.end))
+                marshal.dump((encode_varints(self.offsets), encode_varints(self.lines), self.postings), f)
+        except (IOError, OSError):
+            pass
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def values(self, field):
+        return self.postings[field].iterkeys()
+
+    def messages(self, field, matches):
+        """
+        :param matches: Called with each value of 'field'
+        :return: Set of the numbers of all messages with a value where 'matches' is true
+        """
+        found = set()
+        for value, numbers in self.postings[field].iteritems():
+            if matches(value):
+                found.update(decode_varints(numbers))
+        return found
+
+    def ranges(self, messages):
+        """
+        :param messages: Message numbers
+        :return: list of (start, end, line number at start) byte ranges holding 'messages'
+        """
+        ranges = list()
+        for number in sorted(messages):
+            end = self.offsets[number + 1] if number + 1 < len(self.offsets) else self.end
+            if ranges and ranges[-1][1] == self.offsets[number]:
+                ranges[-1] = (ranges[-1][0], end, ranges[-1][2])
+            else:
+                ranges.append((self.offsets[number], end, self.lines[number]))
+        return ranges
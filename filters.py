@@ -0,0 +1,492 @@
+"""
+Filters for greplog, compiled once from the command line arguments.
+
+"""
+import re
+from iprange import AddressSet, split_patterns
+from mod_security import LogParts
+from timestamps import seconds_of_day
+from utils import Pattern, compile_names_values, required_literals, split_to_dict
+
+__author__ = 'anna'
+
+# The order in which the sections needed by a filter show up in the log.
+STAGES = {
+    LogParts.STARTED: 0,
+    LogParts.REQUEST_HEADERS: 1,
+    LogParts.CONTENT: 2,
+}
+
+
+# Parameters are URL or JSON decoded. Without these in the raw message, their names and values are in it as they are.
+ENCODING_MARKERS = ['%', '\\']
+
+# More strings than this in a group make the prefilter slower than parsing
+MAX_PREFILTER_LITERALS = 64
+
+
+def literal_groups(patterns):
+    """
+    :param patterns: Regular expressions, one of which must match
+    :return: Strings one of which is in any text that one of the patterns matches, or None if there are none
+
+    >>> literal_groups(['10.0.1', '172.16'])
+    ['10', '172']
+    >>> literal_groups(['10.0.1', '[0-9]+']) is None
+    True
+    """
+    literals = list()
+    for pattern in patterns:
+        pattern_literals = required_literals(pattern)
+        if pattern_literals is None:
+            return None
+        literals.extend(pattern_literals)
+    return literals
+
+
+def decoded_literals(pattern):
+    """
+    :return: Strings one of which is in the raw message if a decoded parameter name or value matches 'pattern'
+
+    >>> decoded_literals('user')
+    ['user', '%', '\\\\']
+    >>> decoded_literals('first name')
+    ['first name', '%', '\\\\', '+']
+    """
+    literals = required_literals(pattern)
+    if literals is None:
+        return None
+    return literals + ENCODING_MARKERS + (['+'] if any(' ' in literal for literal in literals) else [])
+
+
+def intersection(sets):
+    """
+    Intersection of 'sets', where None stands for everything.
+
+    >>> sorted(intersection([set([1, 2, 3]), None, set([2, 3, 4])]))
+    [2, 3]
+    >>> intersection([None]) is None
+    True
+    """
+    result = None
+    for s in sets:
+        if s is not None:
+            result = s if result is None else result & s
+    return result
+
+
+class Predicate(object):
+    """
+    Base class for message filters.
+
+    'cost' is a rough estimate of how expensive 'test' is, relative to a single
+    integer comparison. 'section' is the last log section the filter needs.
+    """
+    cost = 1
+    section = LogParts.STARTED
+
+    def __init__(self, option, values):
+        self.name = '{option:s} {values:s}'.format(option=option, values=' '.join(values))
+        self.evaluated = 0
+        self.rejected = 0
+
+    def test(self, message):
+        raise NotImplementedError
+
+    def index_candidates(self, index):
+        """
+        :param index: fieldindex.FieldIndex
+        :return: Set of the message numbers in 'index' that can pass this filter, or None if the index can't tell
+        """
+        return None
+
+    def literals(self):
+        """
+        :return: List of groups of strings. A message can only pass this filter if its raw text
+        contains a string from every group.
+        """
+        return []
+
+    def rank(self):
+        """
+        Expected cost of evaluating this filter per rejected message. Lower is better.
+        Uses the observed reject ratio, smoothed so that unseen filters start at 50%.
+        """
+        reject_ratio = (self.rejected + 1.0) / (self.evaluated + 2.0)
+        return STAGES[self.section], self.cost / reject_ratio
+
+    def __call__(self, message):
+        self.evaluated += 1
+        if self.test(message):
+            return True
+        self.rejected += 1
+        return False
+
+
+class WithHeaders(Predicate):
+    cost = 20
+    section = LogParts.REQUEST_HEADERS
+
+    def __init__(self, names_values):
+        Predicate.__init__(self, '--with-headers',
+                           ['{}={}'.format(k, v) if v else k for k, v in names_values.iteritems()])
+        self.names_values = compile_names_values(names_values)
+
+    def test(self, message):
+        return message.request_headers().get_headers().matches(self.names_values)
+
+    def index_candidates(self, index):
+        return intersection(index.messages('header', name.search) for name in self.names_values)
+
+    def literals(self):
+        patterns = [p.pattern for name_value in self.names_values.iteritems() for p in name_value if p]
+        return [group for group in (literal_groups([p]) for p in patterns) if group]
+
+
+class WithoutHeaders(Predicate):
+    section = LogParts.REQUEST_HEADERS
+
+    def __init__(self, headers):
+        Predicate.__init__(self, '--without-headers', headers)
+        self.names_values = [compile_names_values(split_to_dict([h], '=')) for h in headers]
+        self.cost = 20 * len(self.names_values)
+
+    def test(self, message):
+        headers = message.request_headers().get_headers()
+        return not any(headers.matches(h) for h in self.names_values)
+
+
+class WithMethod(Predicate):
+    cost = 2
+    section = LogParts.REQUEST_HEADERS
+
+    def __init__(self, methods):
+        Predicate.__init__(self, '--with-method', methods)
+        self.methods = frozenset(methods)
+
+    def test(self, message):
+        return str(message.method()) in self.methods
+
+    def index_candidates(self, index):
+        return index.messages('method', self.methods.__contains__)
+
+    def literals(self):
+        return [sorted(self.methods)]
+
+
+class WithParameters(Predicate):
+    cost = 50
+    section = LogParts.CONTENT
+
+    def __init__(self, names_values):
+        Predicate.__init__(self, '--with-parameters',
+                           ['{}={}'.format(k, v) if v else k for k, v in names_values.iteritems()])
+        self.names_values = compile_names_values(names_values)
+
+    def test(self, message):
+        return message.parameters().matches(self.names_values)
+
+    def index_candidates(self, index):
+        return intersection(index.messages('param', name.search) for name in self.names_values)
+
+    def literals(self):
+        patterns = [p.pattern for name_value in self.names_values.iteritems() for p in name_value if p]
+        return [group for group in (decoded_literals(p) for p in patterns) if group]
+
+
+class WithoutParameters(Predicate):
+    section = LogParts.CONTENT
+
+    def __init__(self, parameters):
+        Predicate.__init__(self, '--without-parameters', parameters)
+        self.patterns = [Pattern(p) for p in parameters]
+        self.cost = 20 * len(self.patterns)
+
+    def test(self, message):
+        content = message.content()
+        return not any(content.matches(p) for p in self.patterns)
+
+
+class Timestamp(Predicate):
+    def __init__(self, timestamp):
+        Predicate.__init__(self, '--timestamp', [str(timestamp)])
+        self.time_of_day = seconds_of_day(timestamp)
+
+    def test(self, message):
+        return message.start().time_matches(self.time_of_day)
+
+
+class TimestampBetween(Predicate):
+    def __init__(self, between):
+        Predicate.__init__(self, '--timestamp-between', [str(x) for x in between])
+        self.between = tuple(seconds_of_day(x) for x in between)
+
+    def test(self, message):
+        return message.start().time_between(self.between)
+
+
+class Since(Predicate):
+    """
+    Messages logged at or after a point in time. Without a timezone, the point in time is compared
+    with the time as written in the log.
+    """
+
+    def __init__(self, text, point, option='--since'):
+        """
+        :param point: (seconds since epoch, has a timezone), from timestamps.parse_point
+        """
+        Predicate.__init__(self, option, [text])
+        self.seconds, self.aware = point
+
+    def seconds_of(self, start):
+        return start.get_datetime() if self.aware else start.get_local_datetime()
+
+    def test(self, message):
+        seconds = self.seconds_of(message.start())
+        return seconds is not None and seconds >= self.seconds
+
+
+class Until(Since):
+    """
+    Messages logged at or before a point in time.
+    """
+
+    def __init__(self, text, point):
+        Since.__init__(self, text, point, option='--until')
+
+    def test(self, message):
+        seconds = self.seconds_of(message.start())
+        return seconds is not None and seconds <= self.seconds
+
+
+class WithIp(Predicate):
+    """
+    Addresses, CIDR blocks, ranges and @FILE block lists are looked up in an AddressSet,
+    anything else is a regular expression matched at the start of the IP.
+
+    >>> from mod_security import Message
+    >>> message = Message(1, None)
+    >>> message.add(LogParts.STARTED, '[01/Jun/2016:10:15:30 +0200] Vc38cd613e30 2001:db8::1 8631 10.1.1.1 443', 1)
+    >>> WithIp(['2001:db8::/32']).test(message), WithoutIp(['2001:db8::/32']).test(message)
+    (True, False)
+    >>> message = Message(1, None)
+    >>> message.add(LogParts.STARTED, '[01/Jun/2016:10:15:30 +0200] Vc38cd613e31 ::ffff:10.0.0.1 8631 10.1.1.1 443', 1)
+    >>> message.start().get_ip(), WithIp(['2001:db8::/32']).test(message)
+    ('::ffff:10.0.0.1', False)
+    """
+
+    def __init__(self, ips, option='--with-ip'):
+        Predicate.__init__(self, option, ips)
+        blocks, patterns = split_patterns(ips)
+        self.addresses = AddressSet(blocks) if blocks else None
+        self.patterns = [Pattern(ip) for ip in patterns]
+        self.cost = 2 * len(self.patterns) + (4 if blocks else 0)
+
+    def test(self, message):
+        return self.ip_matches(message.start().get_ip())
+
+    def ip_matches(self, ip):
+        return (self.addresses is not None and ip in self.addresses) or any(p.match(ip) for p in self.patterns)
+
+    def index_candidates(self, index):
+        return index.messages('ip', self.ip_matches)
+
+    def literals(self):
+        group = literal_groups([p.pattern for p in self.patterns])
+        if self.addresses is not None and group is not None:
+            addresses = self.addresses.literals()
+            group = group + addresses if addresses else None
+        if not group or len(group) > MAX_PREFILTER_LITERALS:
+            return []
+        return [group]
+
+
+class WithoutIp(WithIp):
+    def __init__(self, ips):
+        WithIp.__init__(self, ips, option='--without-ip')
+
+    def test(self, message):
+        return not WithIp.test(self, message)
+
+    def index_candidates(self, index):
+        return set(xrange(len(index))) - WithIp.index_candidates(self, index)
+
+    def literals(self):
+        return []
+
+
+class Prefilter(object):
+    """
+    Groups of literal strings, taken from the filters, that the raw text of a
+    message must contain one of each for the message to pass the filters.
+    Checked on the whole message before any of it is parsed.
+
+    A group with one string is looked for with find, a group with several
+    with one regular expression, so the message is searched once per group.
+    """
+    name = 'prefilter'
+
+    def __init__(self, groups):
+        # Longer strings are less likely to be found, so they reject more messages
+        groups = sorted(groups, key=lambda group: -min(len(literal) for literal in group))
+        self.searches = [self.search_function(group) for group in groups]
+        self.evaluated = 0
+        self.rejected = 0
+
+    @staticmethod
+    def search_function(group):
+        """
+        :return: Function with the arguments (data, start, end), true if data[start:end] contains a string in 'group'
+        """
+        if len(group) == 1:
+            literal = group[0]
+            return lambda data, start, end: data.find(literal, start, end) >= 0
+        regex = re.compile('|'.join(re.escape(literal) for literal in group))
+        return lambda data, start, end: regex.search(data, start, end) is not None
+
+    @classmethod
+    def build(cls, predicates):
+        """
+        :return: Prefilter for the literals of 'predicates', or None if they have none
+        """
+        groups = [group for p in predicates for group in p.literals()]
+        return cls(groups) if groups else None
+
+    def __call__(self, data, start, end):
+        """
+        :param data: String or mmap with the message in data[start:end]
+        :return: False if the message can't pass the filters
+        """
+        self.evaluated += 1
+        for search in self.searches:
+            if not search(data, start, end):
+                self.rejected += 1
+                return False
+        return True
+
+
+class FilterPlan(object):
+    """
+    All filters given on the command line, as one predicate.
+
+    Patterns are compiled when the plan is built, so each message only pays for
+    the actual matching. Filters are evaluated in log section order, and within
+    a section the cheapest and most selective filter goes first. The order is
+    adjusted every REORDER_INTERVAL messages from the observed reject ratios.
+
+    A message can be filtered in steps, as its sections are parsed. The number
+    of filters it has passed so far is kept in message.filters_passed, which is
+    None until the plan first sees the message.
+    """
+    REORDER_INTERVAL = 1024
+
+    def __init__(self, args):
+        self.predicates = list()
+        self.evaluated = 0
+        self.matched = 0
+        if args.with_headers:
+            self.predicates.append(WithHeaders(args.with_headers))
+        if args.without_headers:
+            self.predicates.append(WithoutHeaders(args.without_headers))
+        if args.with_method:
+            self.predicates.append(WithMethod(args.with_method))
+        if args.with_parameters:
+            self.predicates.append(WithParameters(args.with_parameters))
+        if args.without_parameters:
+            self.predicates.append(WithoutParameters(args.without_parameters))
+        if args.timestamp:
+            self.predicates.append(Timestamp(args.timestamp))
+        if args.timestamp_between:
+            self.predicates.append(TimestampBetween(args.timestamp_between))
+        if args.since:
+            self.predicates.append(Since(*args.since))
+        if args.until:
+            self.predicates.append(Until(*args.until))
+        if args.with_ip:
+            self.predicates.append(WithIp(args.with_ip))
+        if args.without_ip:
+            self.predicates.append(WithoutIp(args.without_ip))
+        self.prefilter = Prefilter.build(self.predicates)
+        self.reorder()
+
+    def find(self, predicate_class):
+        """
+        :return: The predicate of exactly 'predicate_class', or None if there is none
+        """
+        for predicate in self.predicates:
+            if type(predicate) is predicate_class:
+                return predicate
+        return None
+
+    def index_candidates(self, index):
+        """
+        :return: Set of the message numbers in 'index' that can pass all filters, or None if the index can't tell
+        """
+        return intersection(p.index_candidates(index) for p in self.predicates)
+
+    def accepts_raw(self, data, start, end):
+        """
+        Check the raw message data[start:end] with the prefilter, before it is parsed.
+        A rejected message counts as evaluated by the plan.
+        :return: False if the message can't pass the filters
+        """
+        if self.prefilter is None or self.prefilter(data, start, end):
+            return True
+        self.evaluated += 1
+        return False
+
+    def reorder(self):
+        self.predicates.sort(key=lambda p: p.rank())
+
+    def __call__(self, message, section=LogParts.CONTENT):
+        """
+        Evaluate the filters that only need the log sections up to 'section'
+        and haven't been evaluated for 'message' yet.
+        :return: False if any filter rejects the message
+        """
+        position = message.filters_passed
+        if position is None:
+            position = message.filters_passed = 0
+            self.evaluated += 1
+            if self.evaluated % self.REORDER_INTERVAL == 0:
+                self.reorder()
+        stage = STAGES[section]
+        for predicate in self.predicates[position:]:
+            if STAGES[predicate.section] > stage:
+                return True
+            if not predicate(message):
+                return False
+            message.filters_passed += 1
+        if section == LogParts.CONTENT:
+            self.matched += 1
+        return True
+
+    def get_counters(self):
+        """
+        :return: Dictionary with (evaluated, rejected) per filter name, and for the whole plan under None
+        """
+        counters = dict((p.name, (p.evaluated, p.rejected)) for p in self.predicates)
+        if self.prefilter is not None:
+            counters[self.prefilter.name] = (self.prefilter.evaluated, self.prefilter.rejected)
+        counters[None] = (self.evaluated, self.evaluated - self.matched)
+        return counters
+
+    def add_counters(self, counters):
+        for p in self.predicates + ([self.prefilter] if self.prefilter is not None else []):
+            evaluated, rejected = counters.get(p.name, (0, 0))
+            p.evaluated += evaluated
+            p.rejected += rejected
+        evaluated, rejected = counters[None]
+        self.evaluated += evaluated
+        self.matched += evaluated - rejected
+
+    def report(self, stream):
+        """
+        Write per-filter counters to 'stream', in evaluation order
+        """
+        stream.write('{:<40s} {:>10s} {:>10s} {:>10s}\n'.format('filter', 'evaluated', 'passed', 'rejected'))
+        for p in ([self.prefilter] if self.prefilter is not None else []) + self.predicates:
+            stream.write('{:<40s} {:>10d} {:>10d} {:>10d}\n'.format(p.name[:40], p.evaluated,
+                                                                   p.evaluated - p.rejected, p.rejected))
+        stream.write('{:<40s} {:>10d} {:>10d} {:>10d}\n'.format('total', self.evaluated, self.matched,
+                                                               self.evaluated - self.matched))
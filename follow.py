@@ -0,0 +1,305 @@
+"""
+Follow a live audit log, like tail -f.
+
+The ModSecurityLog keeps its state between reads, and only complete lines
+are parsed, so messages that are still being written are picked up when
+they're done. Log rotation (a new file under the same name) and truncation
+are detected. The position can be saved in a checkpoint file, so a restart
+continues where the last run stopped.
+
+On Linux, inotify is used to wait for changes. Elsewhere the file is polled,
+backing off to POLL_MAX_INTERVAL seconds while nothing happens.
+
+"""
+import ctypes
+import ctypes.util
+import errno
+import io
+import json
+import os
+import select
+import time
+
+__author__ = 'anna'
+
+READ_SIZE = 64 * 1024
+POLL_MIN_INTERVAL = 0.1
+POLL_MAX_INTERVAL = 2.0
+CHECKPOINT_INTERVAL = 5.0
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+
+class Checkpoint(object):
+    """
+    Where to continue reading a log: inode, byte offset and line number, or None if lines weren't counted.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.inode = None
+        self.offset = 0
+        self.line_count = 1
+
+    def load(self):
+        """
+        :return: True if a checkpoint was read
+        """
+        try:
+            with open(self.filename) as f:
+                self.from_dict(json.load(f))
+            return True
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return False
+
+    def from_dict(self, data):
+        self.inode = data['inode']
+        self.offset = data['offset']
+        self.line_count = data['line']
+
+    def to_dict(self):
+        return {'inode': self.inode, 'offset': self.offset, 'line': self.line_count}
+
+    def save(self, inode, offset, line_count):
+        self.inode, self.offset, self.line_count = inode, offset, line_count
+        self.write()
+
+    def write(self):
+        temporary = self.filename + '.tmp'
+        try:
+            with open(temporary, 'w') as f:
+                json.dump(self.to_dict(), f)
+            os.rename(temporary, self.filename)
+        except (IOError, OSError):
+            pass
+
+
+def rotated_file(filename, inode):
+    """
+    Find the file that 'filename' was rotated to, e.g. 'filename.1', by its inode.
+    :return: Name of the file, or None if it can't be found
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    prefix = os.path.basename(filename) + '.'
+    try:
+        names = [name for name in os.listdir(directory) if name.startswith(prefix)]
+    except OSError:
+        return None
+    for name in sorted(names):
+        path = os.path.join(directory, name)
+        try:
+            if os.stat(path).st_ino == inode:
+                return path
+        except OSError:
+            pass
+    return None
+
+
+class Inotify(object):
+    """
+    Wait for changes in a directory with inotify. Raises OSError if inotify isn't available.
+    """
+
+    def __init__(self, directory):
+        name = ctypes.util.find_library('c')
+        if not name:
+            raise OSError(errno.ENOSYS, 'No C library')
+        libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(libc, 'inotify_init'):
+            raise OSError(errno.ENOSYS, 'No inotify')
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        mask = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        if libc.inotify_add_watch(self.fd, directory, mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            os.read(self.fd, 64 * 1024)
+
+    def reset(self):
+        pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Poll(object):
+    """
+    Wait for changes by sleeping, longer and longer while nothing happens.
+    """
+
+    def __init__(self):
+        self.interval = POLL_MIN_INTERVAL
+
+    def wait(self, timeout):
+        time.sleep(min(self.interval, timeout))
+        self.interval = min(self.interval * 2, POLL_MAX_INTERVAL)
+
+    def reset(self):
+        self.interval = POLL_MIN_INTERVAL
+
+    def close(self):
+        pass
+
+
+def count_lines(f, end):
+    lines = 0
+    f.seek(0)
+    remaining = end
+    while remaining > 0:
+        block = f.read(min(READ_SIZE, remaining))
+        if not block:
+            break
+        lines += block.count('\n')
+        remaining -= len(block)
+    return lines
+
+
+class Follower(object):
+    """
+    Feed lines appended to 'filename' to 'log', forever.
+    """
+
+    def __init__(self, log, filename, callback, checkpoint=None, line_numbers=True, flush=None):
+        """
+        :param log: ModSecurityLog
+        :param callback: Called with each complete message
+        :param checkpoint: Checkpoint to continue from and update, or None to start at the end of the file
+        :param line_numbers: Count lines before the starting point, so line numbers are right
+        :param flush: Called after each batch of new lines has been parsed
+        """
+        self.log = log
+        self.filename = filename
+        self.callback = callback
+        self.checkpoint = checkpoint
+        self.checkpoint_pending = checkpoint
+        self.line_numbers = line_numbers
+        self.flush = flush
+        self.f = None
+        self.inode = None
+        self.offset = 0
+        self.line_count = 1
+        self.pending = ''
+        self.message_offset = 0
+        self.message_line_count = 1
+        self.saved = time.time()
+        try:
+            self.waiter = Inotify(os.path.dirname(os.path.abspath(filename)))
+        except (OSError, AttributeError):
+            self.waiter = Poll()
+
+    def open(self, from_start):
+        """
+        Open the file. The first time, continue from the checkpoint if there is one. If the log
+        has been rotated since, the rest of the rotated file is read first, if it can be found,
+        and then all of the new file. Otherwise start at the beginning or the end of the file.
+        """
+        checkpoint, self.checkpoint_pending = self.checkpoint_pending, None
+        if checkpoint is not None and checkpoint.inode is None:
+            checkpoint = None
+        filename = self.filename
+        if checkpoint is not None:
+            try:
+                inode = os.stat(self.filename).st_ino
+            except OSError:
+                inode = None
+            if inode != checkpoint.inode:
+                filename = rotated_file(self.filename, checkpoint.inode)
+                if filename is None:
+                    filename, checkpoint, from_start = self.filename, None, True
+        self.f = io.open(filename, 'rb', buffering=0)
+        st = os.fstat(self.f.fileno())
+        self.inode = st.st_ino
+        self.pending = ''
+        self.log.state = None
+        self.log.skipping = False
+        self.log.in_message = False
+        if checkpoint is not None and checkpoint.inode == self.inode and checkpoint.offset <= st.st_size:
+            self.offset, self.line_count = checkpoint.offset, checkpoint.line_count
+            if self.line_count is None:
+                self.line_count = count_lines(self.f, self.offset) + 1 if self.line_numbers else 1
+        elif from_start or checkpoint is not None:
+            # Truncated since the checkpoint, so everything in it is new
+            self.offset, self.line_count = 0, 1
+        else:
+            self.offset = st.st_size
+            self.line_count = count_lines(self.f, self.offset) + 1 if self.line_numbers else 1
+        self.f.seek(self.offset)
+        self.message_offset, self.message_line_count = self.offset, self.line_count
+
+    def read(self):
+        """
+        Parse all complete lines that have been added.
+        :return: True if anything was read
+        """
+        data = self.f.read(READ_SIZE)
+        if not data:
+            return False
+        while data:
+            lines = (self.pending + data).split('\n')
+            self.pending = lines.pop()
+            for line in lines:
+                stripped = line.strip()
+                if stripped.endswith('-A--') and self.log.DELIMITER_PATTERN.match(stripped):
+                    self.message_offset, self.message_line_count = self.offset, self.line_count
+                self.log.parse_line(stripped, self.line_count, callback=self.callback)
+                self.offset += len(line) + 1
+                self.line_count += 1
+            data = self.f.read(READ_SIZE)
+        if self.flush is not None:
+            self.flush()
+        return True
+
+    def resume_point(self):
+        """
+        :return: (offset, line) to continue from: the start of an unfinished message, or the last line read
+        """
+        if self.log.in_message:
+            return self.message_offset, self.message_line_count
+        return self.offset, self.line_count
+
+    def save_checkpoint(self):
+        if self.checkpoint is not None:
+            offset, line_count = self.resume_point()
+            # Lines before the starting point aren't counted without line numbers
+            self.checkpoint.save(self.inode, offset, line_count if self.line_numbers else None)
+        self.saved = time.time()
+
+    def replaced(self):
+        """
+        :return: True if the file has been rotated (another file has the name) or truncated
+        """
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return False  # Rotated, but the new file isn't there yet
+        return st.st_ino != self.inode or st.st_size < self.offset + len(self.pending)
+
+    def run(self):
+        self.open(from_start=False)
+        try:
+            while True:
+                if self.read():
+                    self.waiter.reset()
+                elif self.replaced():
+                    self.read()  # Whatever was written to the old file before it was rotated
+                    self.f.close()
+                    self.open(from_start=True)
+                    continue
+                else:
+                    self.waiter.wait(CHECKPOINT_INTERVAL)
+                if time.time() - self.saved >= CHECKPOINT_INTERVAL:
+                    self.save_checkpoint()
+        finally:
+            self.save_checkpoint()
+            self.f.close()
+            self.waiter.close()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""
+Generate a synthetic serial audit log, for benchmarks and tests.
+
+    python generate.py --messages 100000 > modsec_audit.log
+    python generate.py --size 500 --post-ratio 0.5 --json-ratio 0.8 > large.log
+
+Messages have sections A, B, C (for requests with a body), F, H and Z.
+Bodies are form encoded or JSON. The same seed always gives the same log.
+
+"""
+import argparse
+import datetime
+import json
+import random
+import sys
+import urllib
+
+__author__ = 'anna'
+
+MB = 1024 * 1024
+
+PATHS = ['/', '/index.html', '/login.php', '/search', '/api/v1/items', '/api/v1/users', '/upload',
+         '/static/app.js', '/admin/config.php', '/wp-login.php']
+USER_AGENTS = ['Mozilla/5.0 (X11; Linux x86_64; rv:45.0) Gecko/20100101 Firefox/45.0',
+               'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/51.0',
+               'Mozilla/5.0 (iPhone; CPU iPhone OS 9_3 like Mac OS X) AppleWebKit/601.1.46 Mobile/13E233',
+               'curl/7.47.0', 'python-requests/2.10.0', 'sqlmap/1.0-dev (http://sqlmap.org)']
+LANGUAGES = ['en-US,en;q=0.8', 'sv-SE,sv;q=0.8,en;q=0.5', 'da', 'de-DE', 'fr-FR,fr;q=0.9']
+EXTRA_HEADERS = ['Accept-Encoding: gzip, deflate', 'Connection: keep-alive', 'Cache-Control: no-cache',
+                 'DNT: 1', 'Referer: https://example.com/', 'X-Forwarded-For: 192.0.2.{n}',
+                 'X-Requested-With: XMLHttpRequest', 'Upgrade-Insecure-Requests: 1', 'Pragma: no-cache',
+                 'X-Request-Id: {id}']
+PARAMETER_NAMES = ['q', 'id', 'page', 'user', 'password', 'email', 'lang', 'sort', 'token', 'redirect']
+RESPONSES = ['200 OK', '200 OK', '200 OK', '302 Found', '403 Forbidden', '404 Not Found',
+             '500 Internal Server Error']
+RULE_MESSAGES = ['Pattern match "(?i:union.*select)" at ARGS:q. [id "942100"] [msg "SQL Injection Attack"]',
+                 'Matched phrase "sqlmap" at REQUEST_HEADERS:User-Agent. [id "913100"] [msg "Scanner"]',
+                 'Operator LT matched 5 at TX:inbound_anomaly_score. [id "949110"] [msg "Anomaly Score"]']
+
+
+class Generator(object):
+    def __init__(self, seed=1, start=None, rate=10.0, ips=1000, post_ratio=0.3, json_ratio=0.5,
+                 headers=4, parameters=3, value_size=12):
+        """
+        :param start: datetime of the first message
+        :param rate: Average messages per second
+        :param ips: Number of distinct client IPs
+        :param post_ratio: Share of requests with a body (POST or PUT)
+        :param json_ratio: Share of bodies that are JSON rather than form encoded
+        :param headers: Number of extra request headers, on top of Host, User-Agent, Accept-Language and Cookie
+        :param parameters: Average number of parameters in query strings and bodies
+        :param value_size: Average length of parameter values
+        """
+        self.random = random.Random(seed)
+        self.time = start or datetime.datetime(2016, 6, 1)
+        self.rate = rate
+        self.ips = ['10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255 or 1) for i in xrange(1, ips + 1)]
+        self.post_ratio = post_ratio
+        self.json_ratio = json_ratio
+        self.headers = headers
+        self.parameters = parameters
+        self.value_size = value_size
+
+    def value(self):
+        size = max(1, int(self.random.expovariate(1.0 / self.value_size)))
+        return ''.join(self.random.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in xrange(size))
+
+    def parameter_dict(self):
+        count = max(1, int(self.random.expovariate(1.0 / self.parameters)))
+        return dict((self.random.choice(PARAMETER_NAMES), self.value()) for _ in xrange(count))
+
+    def message(self):
+        """
+        :return: The text of the next message
+        """
+        r = self.random
+        self.time += datetime.timedelta(seconds=r.expovariate(self.rate))
+        boundary = '%08x' % r.getrandbits(32)
+        unique_id = 'V%011x' % r.getrandbits(44)
+        lines = ['--%s-A--' % boundary,
+                 '[%s +0200] %s %s %d 10.1.1.1 443' % (self.time.strftime('%d/%b/%Y:%H:%M:%S'), unique_id,
+                                                        r.choice(self.ips), r.randint(1024, 65535)),
+                 '--%s-B--' % boundary]
+
+        has_body = r.random() < self.post_ratio
+        if has_body:
+            method = r.choice(['POST', 'POST', 'PUT'])
+            query = ''
+        else:
+            method = r.choice(['GET', 'GET', 'GET', 'HEAD', 'DELETE', 'OPTIONS'])
+            query = '?' + urllib.urlencode(self.parameter_dict()) if r.random() < 0.6 else ''
+        lines.append('%s %s%s HTTP/1.1' % (method, r.choice(PATHS), query))
+        lines.append('Host: www.example.com')
+        lines.append('User-Agent: %s' % r.choice(USER_AGENTS))
+        lines.append('Accept-Language: %s' % r.choice(LANGUAGES))
+        lines.append('Cookie: session=%032x' % r.getrandbits(128))
+        for header in r.sample(EXTRA_HEADERS, min(self.headers, len(EXTRA_HEADERS))):
+            lines.append(header.format(n=r.randint(1, 254), id=unique_id))
+
+        if has_body:
+            if r.random() < self.json_ratio:
+                content_type, body = 'application/json', json.dumps(self.parameter_dict())
+            else:
+                content_type, body = 'application/x-www-form-urlencoded', urllib.urlencode(self.parameter_dict())
+            lines.append('Content-Type: %s' % content_type)
+            lines.append('Content-Length: %d' % len(body))
+            lines.append('')
+            lines.append('--%s-C--' % boundary)
+            lines.append(body)
+        lines.append('')
+
+        response = r.choice(RESPONSES)
+        lines.append('--%s-F--' % boundary)
+        lines.append('HTTP/1.1 %s' % response)
+        lines.append('Content-Type: text/html; charset=UTF-8')
+        lines.append('Content-Length: %d' % r.randint(0, 50000))
+        lines.append('')
+        lines.append('--%s-H--' % boundary)
+        if response.startswith('403'):
+            lines.append('Message: Access denied with code 403 (phase 2). %s' % r.choice(RULE_MESSAGES))
+        lines.append('Apache-Handler: proxy-server')
+        lines.append('Stopwatch: %d %d (- - -)' % (r.getrandbits(50), r.randint(100, 100000)))
+        lines.append('Producer: ModSecurity for Apache/2.9.1 (http://www.modsecurity.org/).')
+        lines.append('Server: Apache')
+        lines.append('')
+        lines.append('--%s-Z--' % boundary)
+        lines.append('')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, stream, messages=None, size=None):
+        """
+        Write messages to 'stream' until there are 'messages' of them, or until 'size' bytes are written.
+        :return: (number of messages, number of bytes) written
+        """
+        count = 0
+        written = 0
+        while (messages is None or count < messages) and (size is None or written < size):
+            text = self.message()
+            stream.write(text)
+            count += 1
+            written += len(text)
+        return count, written
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(description='Generate a synthetic mod_security audit log on stdout')
+    parser.add_argument('--messages', help='Number of messages (default 10000)', type=int)
+    parser.add_argument('--size', help='Write SIZE megabytes instead of a number of messages', type=float)
+    parser.add_argument('--seed', help='Random seed', type=int, default=1)
+    parser.add_argument('--rate', help='Average messages per second (default 10)', type=float, default=10.0)
+    parser.add_argument('--ips', help='Number of distinct client IPs (default 1000)', type=int, default=1000)
+    parser.add_argument('--post-ratio', help='Share of requests with a body (default 0.3)', type=float,
+                        default=0.3)
+    parser.add_argument('--json-ratio', help='Share of bodies that are JSON (default 0.5)', type=float,
+                        default=0.5)
+    parser.add_argument('--headers', help='Extra request headers per message (default 4)', type=int, default=4)
+    parser.add_argument('--parameters', help='Average parameters per request (default 3)', type=int, default=3)
+    return parser
+
+
+def main(args):
+    args = get_arg_parser().parse_args(args)
+    if args.messages is None and args.size is None:
+        args.messages = 10000
+    generator = Generator(seed=args.seed, rate=args.rate, ips=args.ips, post_ratio=args.post_ratio,
+                          json_ratio=args.json_ratio, headers=args.headers, parameters=args.parameters)
+    try:
+        generator.write(sys.stdout, args.messages, int(args.size * MB) if args.size else None)
+    except IOError:
+        pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -5,13 +5,29 @@ Parse apache mod_security logs to find interesting log rows.
 
 """
 import argparse
+import auditdir
 import datetime
-import fileinput
-import re
+import fieldindex
+import itertools
+import logreader
+import merge
+import messagecache
+import parallel
 import subprocess
 import sys
-from mod_security import FormattedMessage, ModSecurityLog
-from utils import split_to_dict, split_re
+import timeindex
+from aggregate import Aggregate
+from cStringIO import StringIO
+from fieldindex import FieldIndex
+from filters import FilterPlan, WithIp
+from follow import Checkpoint, Follower
+from messagecache import MessageCache
+from mod_security import FormattedMessage, LogParts, ModSecurityLog, MAX_BODY_SIZE, MAX_PARAMETERS
+from output import background
+from stats import Stats, TimedStream
+from timeindex import TimeIndex, in_ranges
+from timestamps import parse_point
+from utils import Pattern, split_to_dict, split_re
 
 
 # noinspection PyUnusedLocal
@@ -32,11 +48,28 @@ except ImportError:
         return no_color(text, args, kwargs)
 
 
+# Stands in for the text when finding out the escape codes of a Color
+MARKER = '\0'
+
+
 class Color(object):
     def __init__(self, color, on_color, attrs=None):
         self.color = color
         self.on_color = on_color
         self.attrs = attrs
+        self.escapes = dict()
+
+    def get_escapes(self, match):
+        """
+        The escape codes that 'colored' puts before and after text, worked out once.
+        :param match: True for text matching a pattern, which also gets 'on_color'
+        :return: (prefix, suffix)
+        """
+        escapes = self.escapes.get(match)
+        if escapes is None:
+            text = colored(MARKER, color=self.color, on_color=self.on_color if match else None, attrs=self.attrs)
+            escapes = self.escapes[match] = tuple(text.split(MARKER))
+        return escapes
 
 
 class Colors(object):
@@ -60,19 +93,38 @@ def format_split(parts, colors):
         :param attrs: Extra text attributes used by colored
         :return: Color-formatted string
         """
-    return ''.join(
-        [colored(str(text), color=colors.color, on_color=colors.on_color if match else None, attrs=colors.attrs) for
-         (text, match) in parts])
+    plain_prefix, plain_suffix = colors.get_escapes(False)
+    match_prefix, match_suffix = colors.get_escapes(True)
+    return ''.join([(match_prefix + str(text) + match_suffix) if match else (plain_prefix + str(text) + plain_suffix)
+                    for (text, match) in parts])
 
 
 class ColorMessage(FormattedMessage):
+    __slots__ = ()
+
+    def keeps_raw(self, state):
+        """
+        The raw content is shown with --show-raw-content, and searched by --without-parameters
+        """
+        return state == LogParts.CONTENT and bool(self.args.show_raw_content or self.args.without_parameters)
+
+    def body_limits(self):
+        return self.args.max_body_size, self.args.max_parameters
+
     def format_ip(self, ips):
-        return format_split(split_re(self.start().ip, ips), colors=Colors.IP)
+        """
+        :param ips: (AddressSet or None, regular expressions) of --with-ip
+        """
+        addresses, patterns = ips
+        ip = self.start().get_ip()
+        if addresses is not None and ip in addresses:
+            return format_split([(ip, True)], colors=Colors.IP)
+        return format_split(split_re(ip, patterns), colors=Colors.IP)
 
     def format_start(self):
         return '{timestamp:s}{ip:s}'.format(
             timestamp=self.start().format_timestamp() if self.args.show_timestamp else "",
-            ip=self.format_ip(self.args.with_ip) if self.args.show_ip else ""
+            ip=self.format_ip(self.args.with_ip_highlight) if self.args.show_ip else ""
         )
 
     def format_query_parameters(self, headers):
@@ -80,20 +132,20 @@ class ColorMessage(FormattedMessage):
         return ('?' + format_split(parts, colors=Colors.QUERY_PARAMETER)) if parts else ''
 
     def format_method(self, methods):
-        return format_split(split_re(self.request_headers().get_method(), methods), colors=Colors.METHOD)
+        return format_split(split_re(str(self.request_headers().get_method()), methods), colors=Colors.METHOD)
 
     def format_url(self, urls):
         return format_split(split_re(self.request_headers().get_path(), urls), colors=Colors.URL)
 
     def format_request_headers(self):
-        headers = self.request_headers().headers
+        headers = self.request_headers().get_headers()
         if self.args.show_headers:
             for name, value in headers.iteritems():
                 if len(value):
                     value = value[0]
                 else:
                     value = ''
-                if any([re.search(x, name) for x in self.args.show_headers]):
+                if any(x.search(name) for x in self.args.show_header_patterns):
                     yield ('{name:s}{colon:s}{value:s}'.format(
                         name=format_split(split_re(name, self.args.with_headers.iterkeys()),
                                           colors=Colors.HEADER_NAME),
@@ -129,7 +181,7 @@ class ColorMessage(FormattedMessage):
         """
         Colorized string representation of the parameters from the message payload.
         """
-        for name, value in self.content().get_parameters().iteritems():
+        for name, value in self.parameters().iteritems():
             yield ('{name:s}={value:s}'.format(
                 name=format_split(split_re(name, self.args.with_parameters.iterkeys()),
                                   colors=Colors.PARAM_NAME),
@@ -140,40 +192,18 @@ class ColorMessage(FormattedMessage):
     def format_content(self):
         for x in iter(self.content()):
             yield x
+        if self.content().truncated:
+            yield '[truncated]'
 
     @staticmethod
     def format_footer():
         return '---'
 
+    def accepts(self, state):
+        return self.args.filters(self, state)
+
     def show(self):
-        headers = self.request_headers().headers
-        if not headers.matches(self.args.with_headers):
-            return False
-        if self.args.without_headers and any(
-                [headers.matches(h) for h in self.args.without_headers]):
-            return False
-
-        if self.args.with_method and not any([str(self.method()) == m for m in self.args.with_method]):
-            return False
-
-        content = self.content()
-        if not content.get_parameters().matches(self.args.with_parameters):
-            return False
-        if self.args.without_parameters and any(
-                [content.matches(param) for param in self.args.without_parameters]):
-            return False
-
-        if not self.start().time_matches(self.args.timestamp):
-            return False
-        if not self.start().time_between(self.args.timestamp_between):
-            return False
-
-        if self.args.with_ip and not any([self.start().ip_matches(ip) for ip in self.args.with_ip]):
-            return False
-        if self.args.without_ip and any([self.start().ip_matches(ip) for ip in self.args.without_ip]):
-            return False
-
-        return True
+        return self.args.filters(self)
 
     @staticmethod
     def message_handler_factory(stream):
@@ -182,10 +212,6 @@ class ColorMessage(FormattedMessage):
             Show the message if the filters match.
             Yields output, one line at a time
             """
-            request_params = message.request_headers().get_parameters()
-            content_params = message.content().get_parameters()
-            content_params.update(request_params)
-
             if message.show():
                 stream.write(message.format_start() + '\n')
                 stream.write(message.format_request_url() + '\n')
@@ -205,13 +231,20 @@ class ColorMessage(FormattedMessage):
 class GrepLog(ModSecurityLog):
     @staticmethod
     def parse_time(timestamp):
-        return datetime.datetime.strptime(timestamp, '%H:%M:%S')
+        return datetime.datetime.strptime(timestamp, '%H:%M:%S').time()
 
-    def __init__(self, args):
-        super(GrepLog, self).__init__(args, message_class=ColorMessage)
+    def __init__(self, args, reuse_messages=True):
+        super(GrepLog, self).__init__(args, message_class=ColorMessage, reuse_messages=reuse_messages)
         self.args = GrepLog.get_arg_parser().parse_args(args)
-        if self.args.timestamp or self.args.timestamp_between:
+        if self.args.timestamp or self.args.timestamp_between or self.args.since or self.args.until:
             self.args.show_timestamp = True
+        try:
+            if self.args.since:
+                self.args.since = self.args.since, parse_point(self.args.since)
+            if self.args.until:
+                self.args.until = self.args.until, parse_point(self.args.until, end=True)
+        except ValueError as e:
+            GrepLog.get_arg_parser().error(str(e))
         if self.args.timestamp:
             self.args.timestamp = self.parse_time(self.args.timestamp)
         if self.args.timestamp_between:
@@ -225,6 +258,113 @@ class GrepLog(ModSecurityLog):
             self.args.show_headers.extend(self.args.with_headers.keys())
 
         self.args.with_parameters = split_to_dict(self.args.with_parameters, '=')
+        self.args.show_header_patterns = [Pattern(x) for x in self.args.show_headers or []]
+        self.args.filters = FilterPlan(self.args)
+        # Highlight with the addresses of the --with-ip filter, so @FILE block lists are read once
+        with_ip = self.args.filters.find(WithIp)
+        self.args.with_ip_highlight = ((with_ip.addresses, [p.pattern for p in with_ip.patterns])
+                                       if with_ip is not None else (None, []))
+        self.cache = None
+        if self.args.cache and self.args.jobs > 1:
+            GrepLog.get_arg_parser().error('--cache can\'t be combined with --jobs')
+        # The prefilter skips messages without parsing them, which is faster than reading them from the cache
+        if (self.args.cache and self.args.filters.prefilter is None
+                and not (self.args.show_raw_content or self.args.without_parameters)):
+            self.cache = MessageCache(self.args.cache_dir, self.args.cache_size)
+        self.aggregate = None
+        if self.args.count_by:
+            try:
+                self.aggregate = Aggregate(self.args.count_by)
+            except ValueError as e:
+                GrepLog.get_arg_parser().error(str(e))
+        self.stats = None
+        if self.args.stats:
+            self.stats = Stats()
+            self.stats.install([
+                ('format', ColorMessage, [name for name in vars(ColorMessage) if name.startswith('format_')]),
+                ('color', sys.modules[__name__], ['format_split', 'split_re']),
+            ])
+
+    def accepts_raw(self, data, start, end):
+        return self.args.filters.accepts_raw(data, start, end)
+
+    def read_ranges(self, filename):
+        """
+        Use the time and field indexes to find the parts of 'filename' that can match the filters.
+        :return: list of (start, end, first line), or None if the whole file must be read
+        """
+        if filename == '-':
+            return None
+        ranges = self.time_ranges(filename)
+        if self.args.field_index:
+            index = FieldIndex.get(filename)
+        else:
+            index = FieldIndex.load(filename)
+        if index is None:
+            return ranges
+        candidates = self.args.filters.index_candidates(index)
+        if candidates is None:
+            return ranges
+        if ranges is not None:
+            candidates = [n for n in candidates if in_ranges(index.offsets[n], ranges)]
+        return index.ranges(candidates)
+
+    def time_ranges(self, filename):
+        """
+        Use the time index to find the parts of 'filename' that can match --since/--until,
+        or else --timestamp/--timestamp-between.
+        :return: list of (start, end, first line), or None if the whole file must be read
+        """
+        first, last = self.time_window()
+        since = self.args.since[1] if self.args.since else None
+        until = self.args.until[1] if self.args.until else None
+        if (first is None and since is None and until is None) or filename == '-':
+            return None
+        if self.args.time_index:
+            index = TimeIndex.get(filename)
+        else:
+            index = TimeIndex.load(filename)
+            if index is None:
+                return None
+        if since is not None or until is not None:
+            return index.between_ranges(since, until)
+        return index.time_of_day_ranges(first, last)
+
+    def time_window(self):
+        """
+        :return: (first, last) time of day allowed by --timestamp/--timestamp-between, or (None, None)
+        """
+        if self.args.timestamp:
+            return self.args.timestamp, self.args.timestamp
+        if self.args.timestamp_between:
+            return tuple(self.args.timestamp_between)
+        return None, None
+
+    def message_handler(self, stream):
+        """
+        With --count-by, messages that pass the filters are counted instead of formatted.
+        """
+        if self.aggregate is None:
+            return super(GrepLog, self).message_handler(stream)
+
+        def count(message):
+            if message.show():
+                self.aggregate.add(message)
+
+        return count
+
+    def get_counters(self):
+        return (self.args.filters.get_counters(),
+                self.aggregate.get_counters() if self.aggregate is not None else None,
+                self.stats.get_counters() if self.stats is not None else None)
+
+    def add_counters(self, counters):
+        filters, aggregate, stats = counters
+        self.args.filters.add_counters(filters)
+        if self.aggregate is not None:
+            self.aggregate.add_counters(aggregate)
+        if self.stats is not None:
+            self.stats.add_counters(stats)
 
     @staticmethod
     def get_arg_parser():
@@ -264,16 +404,32 @@ class GrepLog(ModSecurityLog):
         parser.add_argument('--show-raw-content',
                             help='Show raw content. Normally only parsed post-data is displayed.',
                             action='store_true')
+        parser.add_argument('--max-body-size',
+                            help='Keep and search at most BYTES of each request body, skip the rest '
+                                 + '(default %d, 0 for no limit)' % MAX_BODY_SIZE,
+                            metavar='BYTES',
+                            type=int,
+                            default=MAX_BODY_SIZE)
+        parser.add_argument('--max-parameters',
+                            help='Parse at most N parameters from each request body (default %d, 0 for no limit)'
+                                 % MAX_PARAMETERS,
+                            metavar='N',
+                            type=int,
+                            default=MAX_PARAMETERS)
         parser.add_argument('--with-method',
                             help='Show only logs where request method is METHOD',
                             metavar='METHOD',
                             nargs='+')
         parser.add_argument('--with-ip',
-                            help='Show only logs where ip matches IP. Also enables --show-ip',
+                            help='Show only logs where ip matches IP: an address, a CIDR block (10.0.4.0/22), '
+                                 + 'a range (FIRST-LAST), @FILE with one of those per line, or a regular expression. '
+                                 + 'Also enables --show-ip',
                             metavar='IP',
                             nargs='+')
         parser.add_argument('--without-ip',
-                            help='Don\'t show logs where ip matches IP. Also enables --show-ip',
+                            help='Don\'t show logs where ip matches IP: an address, a CIDR block (10.0.4.0/22), '
+                                 + 'a range (FIRST-LAST), @FILE with one of those per line, or a regular expression. '
+                                 + 'Also enables --show-ip',
                             metavar='IP',
                             nargs='+')
         parser.add_argument('--timestamp',
@@ -283,7 +439,87 @@ class GrepLog(ModSecurityLog):
                             help='Show only logs with timestamp between START and END. Also enables --show-timestamp',
                             metavar=('START', 'END'),
                             nargs=2)
-        parser.add_argument('file', help='Logfile(s)',
+        parser.add_argument('--since',
+                            help='Show only logs from TIME on: YYYY-MM-DD[ HH:MM[:SS]][ +HHMM]. Without a timezone, '
+                                 + 'TIME is compared with the time as written in the log. Also enables --show-timestamp',
+                            metavar='TIME')
+        parser.add_argument('--until',
+                            help='Show only logs up to and including TIME, like --since. A date without a time '
+                                 + 'means the end of that day. Also enables --show-timestamp',
+                            metavar='TIME')
+        parser.add_argument('--merge',
+                            help='Show the messages of all the log files in time order, instead of file by file. '
+                                 + 'Each file is parsed in a process of its own. Files that are entirely outside '
+                                 + '--since/--until are skipped',
+                            action='store_true')
+        parser.add_argument('--filter-stats',
+                            help='Show how many messages each filter evaluated and rejected, on stderr',
+                            action='store_true')
+        parser.add_argument('--stats',
+                            help='Show where the time went on stderr: time per stage, messages, bytes read, '
+                                 + 'throughput and peak memory',
+                            action='store_true')
+        parser.add_argument('--time-index',
+                            help='Use a time index (LOGFILE' + timeindex.EXTENSION + ') to find the parts of the log '
+                                 + 'that match --timestamp, --timestamp-between, --since or --until. The index is built if it is missing '
+                                 + 'or out of date. An existing index is used even without this option.',
+                            action='store_true')
+        parser.add_argument('--field-index',
+                            help='Use a field index (LOGFILE' + fieldindex.EXTENSION + ') to find the messages '
+                                 + 'that can match --with-ip, --without-ip, --with-method, and the names in '
+                                 + '--with-headers and --with-parameters. The index is built if it is missing '
+                                 + 'or out of date. An existing index is used even without this option.',
+                            action='store_true')
+        parser.add_argument('--build-index',
+                            help='Build time and field indexes for the log files, then exit',
+                            action='store_true')
+        parser.add_argument('--cache',
+                            help='Keep the parsed messages of each log in a cache, and search the cache instead of '
+                                 + 'parsing the log again, as long as the log doesn\'t change. Not used with '
+                                 + '--show-raw-content or --without-parameters, which need the raw content, with '
+                                 + 'filters that can skip messages without parsing them, or where a time or field '
+                                 + 'index applies. Can\'t be combined with --jobs',
+                            action='store_true')
+        parser.add_argument('--cache-dir',
+                            help='Directory for --cache (default ' + messagecache.DEFAULT_DIRECTORY + ')',
+                            metavar='DIRECTORY',
+                            default=messagecache.DEFAULT_DIRECTORY)
+        parser.add_argument('--cache-size',
+                            help='Remove the least recently used logs from the cache when it grows over MB megabytes '
+                                 + '(default %d)' % messagecache.DEFAULT_SIZE,
+                            metavar='MB',
+                            type=int,
+                            default=messagecache.DEFAULT_SIZE)
+        parser.add_argument('--follow', '-f',
+                            help='Keep reading the log as it grows, like tail -f. Handles log rotation and truncation. '
+                                 + 'Output is written directly, not through less. With --count-by or --filter-stats, the counts are '
+                                 + 'shown when following stops, e.g. on Ctrl-C',
+                            action='store_true')
+        parser.add_argument('--checkpoint',
+                            help='With --follow, save the position in the log to CHECKPOINT and continue from it '
+                                 + 'next time',
+                            metavar='CHECKPOINT')
+        parser.add_argument('--jobs', '-j',
+                            help='Parse with JOBS processes. Uncompressed files are split in ranges of whole messages',
+                            metavar='JOBS',
+                            type=int,
+                            default=1)
+        parser.add_argument('--audit-index',
+                            help='Index file of the concurrent audit log directories. '
+                                 + 'Defaults to DIRECTORY/' + auditdir.INDEX_NAME + ' if it exists',
+                            metavar='INDEX')
+        parser.add_argument('--count-by',
+                            help='Don\'t show messages, count them by FIELD and show the most frequent values. '
+                                 + 'FIELD is ip, path, method, status, header:NAME or param:NAME. '
+                                 + 'With several fields, combinations are counted',
+                            metavar='FIELD',
+                            nargs='+')
+        parser.add_argument('--top',
+                            help='With --count-by, show the N most frequent values (default 20)',
+                            metavar='N',
+                            type=int,
+                            default=20)
+        parser.add_argument('file', help='Logfile(s), or directories with concurrent audit logs',
                             nargs='+')
         return parser
 
@@ -299,28 +535,149 @@ def header(header_text):
                          colored(l * '=', 'green', attrs=['bold']))
 
 
+def grep_files(greplog, args, filenames, stream):
+    if greplog.args.merge and len(filenames) > 1 and '-' not in filenames:
+        grep_merged(greplog, args, filenames, stream)
+        return
+    message_handler = greplog.message_handler(stream)
+    show_headers = greplog.aggregate is None
+    if greplog.args.jobs > 1:
+        filename = None
+        for name, output, counters in parallel.scan(GrepLog, args, filenames, greplog.args.jobs,
+                                                    line_numbers=greplog.args.n):
+            if filename != name and show_headers:
+                stream.write(header(name))
+            filename = name
+            stream.write(output)
+            greplog.add_counters(counters)
+        return
+    for filename in filenames:
+        if show_headers:
+            stream.write(header(filename))
+        ranges = greplog.read_ranges(filename)
+        if ranges is None and greplog.cache is not None:
+            limits = (greplog.args.max_body_size, greplog.args.max_parameters)
+            greplog.cache.parse_file(greplog, filename, message_handler, limits)
+            continue
+        if ranges is None:
+            logreader.parse_file(greplog, filename, message_handler, line_numbers=greplog.args.n)
+            continue
+        for start, end, first_line in ranges:
+            logreader.parse_file(greplog, filename, message_handler, start, end, first_line,
+                                 line_numbers=greplog.args.n)
+
+
+def grep_merged(greplog, args, filenames, stream):
+    """
+    Search 'filenames' at the same time, showing the matching messages of all of them in time order.
+    Files that are entirely outside --since/--until are skipped.
+    """
+    since = greplog.args.since[1] if greplog.args.since else None
+    until = greplog.args.until[1] if greplog.args.until else None
+    filenames = [filename for filename in filenames if merge.in_window(filename, since, until)]
+    for _, output, counters in merge.merge(GrepLog, args, filenames, line_numbers=greplog.args.n):
+        if counters is not None:
+            greplog.add_counters(counters)
+        stream.write(output)
+
+
+def grep_audit_dir(greplog, args, root, stream):
+    """
+    Search the transaction files of a concurrent audit log, in timestamp order.
+    Only files with matching messages get a header.
+    """
+    first, last = greplog.time_window()
+    since = greplog.args.since[1] if greplog.args.since else None
+    until = greplog.args.until[1] if greplog.args.until else None
+    filenames = auditdir.transactions(root, greplog.args.audit_index, first, last, since, until)
+    if greplog.args.jobs > 1:
+        for outputs, counters in parallel.scan_files(GrepLog, args, filenames, greplog.args.jobs,
+                                                     line_numbers=greplog.args.n):
+            for filename, output in outputs:
+                if output:
+                    stream.write(header(filename))
+                    stream.write(output)
+            greplog.add_counters(counters)
+        return
+    for filename in filenames:
+        output = StringIO()
+        logreader.parse_file(greplog, filename, greplog.message_handler(output),
+                             line_numbers=greplog.args.n)
+        if output.tell():
+            stream.write(header(filename))
+            stream.write(output.getvalue())
+
+
 def main(args):
     greplog = GrepLog(args)
 
-    # Pipe output through less. Hackish, but better than writing my own pager.
-    p = subprocess.Popen(['less', '-F', '-R', '-K'],
-                         stdin=subprocess.PIPE,
-                         stdout=sys.stdout)
-    filename = None
-    message_handler = ColorMessage.message_handler_factory(p.stdin)
+    if greplog.args.build_index:
+        for filename in greplog.args.file:
+            if auditdir.is_audit_dir(filename):
+                continue
+            try:
+                TimeIndex.build(filename).save()
+                FieldIndex.build(filename).save()
+            except (IOError, OSError):
+                pass
+        return
+
+    if greplog.args.follow:
+        filenames = greplog.args.file
+        if len(filenames) != 1 or filenames[0] == '-' or auditdir.is_audit_dir(filenames[0]):
+            GrepLog.get_arg_parser().error('--follow needs exactly one log file')
+        checkpoint = None
+        if greplog.args.checkpoint:
+            checkpoint = Checkpoint(greplog.args.checkpoint)
+            checkpoint.load()
+        follower = Follower(greplog, greplog.args.file[0], greplog.message_handler(sys.stdout),
+                            checkpoint=checkpoint, line_numbers=greplog.args.n, flush=sys.stdout.flush)
+        try:
+            follower.run()
+        except (KeyboardInterrupt, IOError):
+            pass
+        # Counts are only complete when following stops
+        try:
+            if greplog.aggregate is not None:
+                greplog.aggregate.report(sys.stdout, greplog.args.top)
+        except IOError:
+            pass
+        if greplog.args.filter_stats:
+            greplog.args.filters.report(sys.stderr)
+        return
+
+    # Pipe output through less when writing to a terminal. Hackish, but better than writing my own pager.
+    p = None
+    stream = sys.stdout
+    if sys.stdout.isatty():
+        p = subprocess.Popen(['less', '-F', '-R', '-K'],
+                             stdin=subprocess.PIPE,
+                             stdout=sys.stdout)
+        stream = p.stdin
     try:
-        for line in fileinput.input(greplog.args.file, openhook=fileinput.hook_compressed):
-
-            if filename != fileinput.filename():
-                filename = fileinput.filename()
-                p.stdin.write(header(filename))
-            greplog.parse_line(line.strip(), fileinput.filelineno(), callback=message_handler)
-    except (KeyboardInterrupt, IOError):
+        # With --stats, time the writes made by the background thread, not the handing over to it
+        with background(stream if greplog.stats is None else TimedStream(stream)) as out:
+            for is_dir, filenames in itertools.groupby(greplog.args.file, auditdir.is_audit_dir):
+                if is_dir:
+                    for root in filenames:
+                        grep_audit_dir(greplog, args, root, out)
+                else:
+                    grep_files(greplog, args, list(filenames), out)
+            if greplog.aggregate is not None:
+                greplog.aggregate.report(out, greplog.args.top)
+    except (KeyboardInterrupt, IOError, OSError):
         pass
     finally:
-        p.stdin.close()
-        p.wait()
-
+        if p is not None:
+            p.stdin.close()
+            p.wait()
+        if greplog.args.filter_stats:
+            greplog.args.filters.report(sys.stderr)
+        if greplog.cache is not None:
+            greplog.cache.evict()
+        if greplog.stats is not None:
+            filters = greplog.args.filters
+            greplog.stats.report(sys.stderr, filters.evaluated, filters.matched, filters.prefilter)
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -0,0 +1,198 @@
+"""
+IP addresses, CIDR blocks and address ranges for --with-ip and --without-ip.
+
+Addresses are parsed into integers once, and the blocks are merged into
+sorted, non-overlapping intervals, one list for IPv4 and one for IPv6. Looking
+up an address is a binary search, so a block list with thousands of entries
+costs about the same as a single block.
+
+"""
+import binascii
+import socket
+from bisect import bisect_right
+
+__author__ = 'anna'
+
+BLOCK_LIST_PREFIX = '@'
+COMMENT = '#'
+VERSIONS = ((4, socket.AF_INET, 32), (6, socket.AF_INET6, 128))
+
+
+def parse_address(text):
+    """
+    :return: (version, address as an integer), or None if 'text' isn't an IP address
+
+    >>> parse_address('10.0.0.1')
+    (4, 167772161)
+    >>> parse_address('::1')
+    (6, 1)
+    >>> parse_address('10.0.1') is None
+    True
+    """
+    if not text:
+        return None
+    for version, family, _ in VERSIONS:
+        try:
+            return version, int(binascii.hexlify(socket.inet_pton(family, text)), 16)
+        except (socket.error, ValueError):
+            pass
+    return None
+
+
+def parse_block(text):
+    """
+    Parse an address, a CIDR block (ADDRESS/BITS) or a range (FIRST-LAST).
+    Host bits in a CIDR block are ignored.
+
+    :return: (version, first, last), or None if 'text' is none of them
+
+    >>> parse_block('10.0.4.0/22') == (4, 0x0a000400, 0x0a0007ff)
+    True
+    >>> parse_block('10.0.0.1-10.0.0.50') == (4, 0x0a000001, 0x0a000032)
+    True
+    >>> parse_block('2001:db8::/32') == (6, 0x20010db8 << 96, ((0x20010db8 + 1) << 96) - 1)
+    True
+    >>> parse_block('10.0.1') is None
+    True
+    >>> parse_block('10.0.0.0/33') is None
+    True
+    """
+    text = text.strip()
+    if '/' in text:
+        address, bits = text.split('/', 1)
+        address = parse_address(address)
+        if address is None or not bits.isdigit():
+            return None
+        version, value = address
+        size = 32 if version == 4 else 128
+        bits = int(bits)
+        if bits > size:
+            return None
+        host_mask = (1 << (size - bits)) - 1
+        return version, value & ~host_mask, value | host_mask
+    if '-' in text:
+        first, last = [parse_address(part.strip()) for part in text.split('-', 1)]
+        if first is None or last is None or first[0] != last[0] or first[1] > last[1]:
+            return None
+        return first[0], first[1], last[1]
+    address = parse_address(text)
+    if address is None:
+        return None
+    return address[0], address[1], address[1]
+
+
+def read_block_list(filename):
+    """
+    :return: The entries of a block list file, one per line. Blank lines and # comments are skipped.
+    """
+    with open(filename) as f:
+        return [entry for entry in (line.split(COMMENT, 1)[0].strip() for line in f) if entry]
+
+
+def split_patterns(values):
+    """
+    Sort the --with-ip/--without-ip values into address blocks and regular expressions.
+    A value @FILE is replaced by the entries of the block list FILE.
+
+    :return: (list of (version, first, last), list of regular expressions)
+
+    >>> split_patterns(['10.0.1', '192.168.0.0/16']) == ([(4, 0xc0a80000, 0xc0a8ffff)], ['10.0.1'])
+    True
+    """
+    blocks = list()
+    patterns = list()
+    for value in values:
+        entries = read_block_list(value[1:]) if value.startswith(BLOCK_LIST_PREFIX) else [value]
+        for entry in entries:
+            block = parse_block(entry)
+            if block is None:
+                patterns.append(entry)
+            else:
+                blocks.append(block)
+    return blocks, patterns
+
+
+def merge(intervals):
+    """
+    :return: Sorted (starts, ends) of the union of the (first, last) 'intervals'
+
+    >>> merge([(5, 9), (1, 2), (8, 12), (3, 3)])
+    ([1, 5], [3, 12])
+    """
+    starts = list()
+    ends = list()
+    for first, last in sorted(intervals):
+        if ends and first <= ends[-1] + 1:
+            ends[-1] = max(ends[-1], last)
+        else:
+            starts.append(first)
+            ends.append(last)
+    return starts, ends
+
+
+def ipv4_prefix(first, last):
+    """
+    :return: The text that every IPv4 address in [first, last] starts with, up to a dot
+
+    >>> ipv4_prefix(0x0a000400, 0x0a0007ff)
+    '10.0.'
+    >>> ipv4_prefix(0x0a000001, 0x0a000001)
+    '10.0.0.1'
+    >>> ipv4_prefix(0, 0xffffffff)
+    ''
+    """
+    first_octets = socket.inet_ntoa(binascii.unhexlify('%08x' % first)).split('.')
+    last_octets = socket.inet_ntoa(binascii.unhexlify('%08x' % last)).split('.')
+    common = 0
+    while common < 4 and first_octets[common] == last_octets[common]:
+        common += 1
+    if common == 4:
+        return '.'.join(first_octets)
+    return ''.join(octet + '.' for octet in first_octets[:common])
+
+
+class AddressSet(object):
+    """
+    A set of IP address blocks, looked up by the text of an address.
+    The last address looked up is remembered, since messages in a row often come from the same client.
+
+    >>> blocks = AddressSet([parse_block('10.0.4.0/22'), parse_block('2001:db8::/32')])
+    >>> '10.0.5.17' in blocks, '10.0.8.1' in blocks, '2001:db8::1' in blocks, '10.0.5' in blocks
+    (True, False, True, False)
+    """
+
+    def __init__(self, blocks):
+        self.blocks = list(blocks)
+        self.intervals = dict()
+        for version, _, _ in VERSIONS:
+            self.intervals[version] = merge((first, last) for block_version, first, last in self.blocks
+                                            if block_version == version)
+        self.last_ip = None
+        self.last_result = False
+
+    def __contains__(self, ip):
+        if ip == self.last_ip:
+            return self.last_result
+        result = False
+        address = parse_address(ip)
+        if address is not None:
+            starts, ends = self.intervals[address[0]]
+            i = bisect_right(starts, address[1]) - 1
+            result = i >= 0 and address[1] <= ends[i]
+        self.last_ip, self.last_result = ip, result
+        return result
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def literals(self):
+        """
+        :return: Strings one of which is in the text of any address in the set, or None if there are none to be found
+        """
+        literals = set()
+        for version, first, last in self.blocks:
+            prefix = ipv4_prefix(first, last) if version == 4 else ''
+            if not prefix:
+                return None
+            literals.add(prefix)
+        return sorted(literals)
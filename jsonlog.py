@@ -1,27 +1,56 @@
 #!/usr/bin/env python
 __author__ = 'Anna Holmgren'
 import argparse
-import fileinput
+import auditdir
+import contextlib
+import itertools
 import json
+import logreader
+import merge
+import mmap
+import os
+import parallel
 import sys
-from mod_security import ModSecurityLog, FormattedMessage
+from follow import Checkpoint, rotated_file
+from mod_security import LogParts, ModSecurityLog, FormattedMessage, MAX_BODY_SIZE, MAX_PARAMETERS
+from operator import itemgetter
+from output import background
+
+try:
+    import ujson
+
+    ENCODER = 'ujson'
+
+    def encode(record):
+        return ujson.dumps(record, escape_forward_slashes=False)
+except ImportError:
+    ENCODER = 'json'
+    encode = json.dumps
+
+
+STATE_EXTENSION = '.state'
 
 
 def parameter_to_dict(parameters):
-    ret = dict()
-    for name, value in parameters.iteritems():
-        if len(value) == 1:
-            ret[name] = value[0]
-        else:
-            ret[name] = value
-    return ret
+    return dict((name, value[0] if len(value) == 1 else value) for name, value in parameters.iteritems())
 
 
 class JsonMessage(FormattedMessage):
+    __slots__ = ()
+
+    def keeps_raw(self, state):
+        """
+        The raw content is written along with the parsed payload
+        """
+        return state == LogParts.CONTENT
+
+    def body_limits(self):
+        return self.args.max_body_size, self.args.max_parameters
+
     def format_start(self):
         ret = dict()
 
-        ret['timestamp'] = self.start().datetime
+        ret['timestamp'] = self.start().get_datetime()
         ret['ip'] = self.start().get_ip()
         ret['request_id'] = self.start().get_id()
         return ret
@@ -35,7 +64,7 @@ class JsonMessage(FormattedMessage):
         if len(req.get_query_string()):
             ret['query_string'] = req.get_query_string()
 
-        parameters = parameter_to_dict(req.parameters)
+        parameters = parameter_to_dict(req.get_parameters())
         if parameters:
             ret['parameters'] = parameters
             
@@ -54,27 +83,22 @@ class JsonMessage(FormattedMessage):
         if payload:
             d['payload'] = payload
         d['content'] = self.content().raw_data
+        if self.content().truncated:
+            d['truncated'] = True
         return d
 
+    def to_record(self):
+        request = self.format_request_headers()
+        request.update(self.format_start())
+        content = self.format_content()
+        if content:
+            request.update(content)
+        return {'request': request, 'response': {'headers': self.format_response_headers()}}
+
     @staticmethod
     def message_handler_factory(stream):
         def handle(message):
-
-            jsonmessage = dict()
-
-            jsonmessage['request'] = message.format_request_headers()
-            jsonmessage['request'].update(message.format_start())
-
-            content = message.format_content()
-            if content:
-                jsonmessage['request'].extend(content)
-
-            jsonmessage['response'] = dict()
-            jsonmessage['response']['headers'] = message.format_response_headers()
-
-            jsonobject = json.dumps(jsonmessage)
-
-            stream.write(jsonobject + '\n')
+            stream.write(encode(message.to_record()) + '\n')
 
         return handle
 
@@ -82,37 +106,206 @@ class JsonMessage(FormattedMessage):
 class JsonLog(ModSecurityLog):
 
     def __init__(self, args):
-        super(JsonLog, self).__init__(args, message_class=JsonMessage)
+        super(JsonLog, self).__init__(args, message_class=JsonMessage, reuse_messages=True)
         self.args = self.get_arg_parser().parse_args(args)
 
     @staticmethod
     def get_arg_parser():
         parser = argparse.ArgumentParser(description='Parse mod_security logs')
-        parser.add_argument('file', help='Logfile(s)',
+        parser.add_argument('--jobs', '-j',
+                            help='Parse with JOBS processes. Uncompressed files are split in ranges of whole messages',
+                            metavar='JOBS',
+                            type=int,
+                            default=1)
+        parser.add_argument('--audit-index',
+                            help='Index file of the concurrent audit log directories. '
+                                 + 'Defaults to DIRECTORY/' + auditdir.INDEX_NAME + ' if it exists',
+                            metavar='INDEX')
+        parser.add_argument('--max-body-size',
+                            help='Keep at most BYTES of each request body, skip the rest and set "truncated" '
+                                 + '(default %d, 0 for no limit)' % MAX_BODY_SIZE,
+                            metavar='BYTES',
+                            type=int,
+                            default=MAX_BODY_SIZE)
+        parser.add_argument('--max-parameters',
+                            help='Parse at most N parameters from each request body, and set "truncated" if there '
+                                 + 'are more (default %d, 0 for no limit)' % MAX_PARAMETERS,
+                            metavar='N',
+                            type=int,
+                            default=MAX_PARAMETERS)
+        parser.add_argument('--incremental',
+                            help='Only convert the messages added since the last run, and append them to '
+                                 + 'LOGFILE.json. Where to continue is kept in LOGFILE.json' + STATE_EXTENSION,
+                            action='store_true')
+        parser.add_argument('--merge',
+                            help='Write the messages of all the log files to stdout in time order. '
+                                 + 'Each file is parsed in a process of its own',
+                            action='store_true')
+        parser.add_argument('--stdout',
+                            help='Write all messages to stdout, one JSON object per line, instead of to LOGFILE.json',
+                            action='store_true')
+        parser.add_argument('file', help='Logfile(s), or directories with concurrent audit logs. '
+                                         + 'A directory is written to DIRECTORY.json in timestamp order',
                             nargs='+')
         return parser
 
 
+@contextlib.contextmanager
+def output(jsonlog, name, mode='w'):
+    """
+    Where to write the messages of the log 'name': stdout with --stdout, otherwise NAME.json
+    """
+    if jsonlog.args.stdout:
+        with background(sys.stdout) as writer:
+            yield writer
+    else:
+        with open(name + '.json', mode) as fp, background(fp) as writer:
+            yield writer
+
+
+class ConversionState(Checkpoint):
+    """
+    Where an incremental conversion of a log stopped, and the size of LOGFILE.json at that point.
+    """
+
+    def __init__(self, filename):
+        super(ConversionState, self).__init__(filename)
+        self.output_size = None
+
+    def from_dict(self, data):
+        super(ConversionState, self).from_dict(data)
+        self.output_size = data.get('output')
+
+    def to_dict(self):
+        data = super(ConversionState, self).to_dict()
+        data['output'] = self.output_size
+        return data
+
+
+def convert_complete(jsonlog, filename, fp, start):
+    """
+    Convert the complete messages in 'filename' from offset 'start'. A message at the end
+    that is still being written is left for the next run.
+
+    :return: Offset to continue from
+    """
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= start:
+            return start
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    message_handler = JsonMessage.message_handler_factory(fp)
+    completed = [False]
+
+    def handle(message):
+        completed[0] = True
+        message_handler(message)
+
+    try:
+        for message_start, message_end in logreader.iter_messages(data, start, size):
+            completed[0] = False
+            jsonlog.parse_message(data, message_start, message_end, 0, callback=handle)
+            if message_end == size and not completed[0]:
+                return message_start
+        if data[size - 1] != '\n':
+            # Don't skip a line that is being written, it may be the start of the next message
+            return max(start, data.rfind('\n', start, size) + 1)
+        return size
+    finally:
+        data.close()
+
+
+def convert_incremental(jsonlog, filename):
+    """
+    Append the messages added to 'filename' since the last run to its output.
+
+    The state file keeps the inode of the log, the offset after the last complete
+    message and the size of the output. If the log has been rotated, the rest of the
+    rotated file is converted first, if it can be found next to the log. If the log
+    has been truncated, or the output doesn't match the state, it starts over.
+    """
+    state = ConversionState(filename + '.json' + STATE_EXTENSION)
+    mode = 'a'
+    if not state.load() or (not jsonlog.args.stdout and
+                            not (os.path.isfile(filename + '.json') and
+                                 os.path.getsize(filename + '.json') == state.output_size)):
+        state.inode, state.offset, mode = None, 0, 'w'
+    inode = os.stat(filename).st_ino
+    with output(jsonlog, filename, mode) as fp:
+        if state.inode is not None and state.inode != inode:
+            rotated = rotated_file(filename, state.inode)
+            if rotated is not None:
+                convert_complete(jsonlog, rotated, fp, state.offset)
+            state.offset = 0
+        elif state.offset > os.path.getsize(filename):
+            state.offset = 0
+        offset = convert_complete(jsonlog, filename, fp, state.offset)
+    if not jsonlog.args.stdout:
+        state.output_size = os.path.getsize(filename + '.json')
+    state.save(inode, offset, 0)
+
+
+def convert(jsonlog, filenames, fp):
+    """
+    Convert 'filenames' in this process, writing to 'fp'.
+    """
+    message_handler = JsonMessage.message_handler_factory(fp)
+    for filename in filenames:
+        logreader.parse_file(jsonlog, filename, message_handler, line_numbers=False)
+
+
+def convert_files(jsonlog, args, filenames):
+    """
+    Convert each file in 'filenames'. With --jobs, each file, or each range of a large file, is
+    converted by a worker process, and the output is written in file order.
+    With --merge, the messages of all files are written to stdout in time order.
+    With --incremental, uncompressed files are converted from where the last run stopped.
+    """
+    if jsonlog.args.merge and len(filenames) > 1 and '-' not in filenames:
+        with background(sys.stdout) as fp:
+            for _, chunk, _ in merge.merge(JsonLog, args, filenames):
+                fp.write(chunk)
+        return
+    if jsonlog.args.incremental:
+        incremental = [filename for filename in filenames
+                       if filename != '-' and not logreader.is_compressed(filename)]
+        for filename in incremental:
+            convert_incremental(jsonlog, filename)
+        filenames = [filename for filename in filenames if filename not in incremental]
+    if jsonlog.args.jobs > 1:
+        results = parallel.scan(JsonLog, args, filenames, jsonlog.args.jobs)
+        for filename, chunks in itertools.groupby(results, itemgetter(0)):
+            with output(jsonlog, filename) as fp:
+                for _, chunk, _ in chunks:
+                    fp.write(chunk)
+        return
+    for filename in filenames:
+        with output(jsonlog, filename) as fp:
+            convert(jsonlog, [filename], fp)
+
+
+def convert_audit_dir(jsonlog, args, root):
+    filenames = auditdir.transactions(root, jsonlog.args.audit_index)
+    with output(jsonlog, auditdir.output_name(root)) as fp:
+        if jsonlog.args.jobs > 1:
+            for outputs, _ in parallel.scan_files(JsonLog, args, filenames, jsonlog.args.jobs):
+                fp.write(''.join(chunk for _, chunk in outputs))
+        else:
+            convert(jsonlog, filenames, fp)
+
+
 def main(args):
-    greplog = JsonLog(args)
+    jsonlog = JsonLog(args)
 
-    filename = None
-    fp = None
-    message_handler = JsonMessage.message_handler_factory(sys.stdout)
     try:
-        for line in fileinput.input(greplog.args.file, openhook=fileinput.hook_compressed):
-            if filename != fileinput.filename():
-                filename = fileinput.filename()
-                if fp:
-                    fp.close()
-                fp = open(filename + '.json', 'w')
-                message_handler = JsonMessage.message_handler_factory(fp)
-            greplog.parse_line(line.strip(), fileinput.filelineno(), callback=message_handler)
-    except (KeyboardInterrupt, IOError):
+        for is_dir, filenames in itertools.groupby(jsonlog.args.file, auditdir.is_audit_dir):
+            if is_dir:
+                for root in filenames:
+                    convert_audit_dir(jsonlog, args, root)
+            else:
+                convert_files(jsonlog, args, list(filenames))
+    except (KeyboardInterrupt, IOError, OSError):
         pass
-    finally:
-        if fp:
-            fp.close()
 
 
 if __name__ == '__main__':
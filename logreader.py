@@ -0,0 +1,357 @@
+"""
+Feed audit log files to a ModSecurityLog.
+
+Uncompressed files are memory mapped and handed to the parser one whole
+message at a time. Compressed files and stdin are read line by line.
+
+Compressed files (gzip, bzip2, xz and zstd) are decompressed in a background
+thread, a few large blocks ahead of the parser, so decompression and
+parsing overlap. BGZF files (gzip made of independent blocks, as written by
+bgzip) are decompressed by several threads at once. xz needs the lzma
+module (backports.lzma on Python 2), and zstd the zstandard module.
+
+"""
+import Queue
+import bz2
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import threading
+import zlib
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+from mod_security import ModSecurityLog
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__author__ = 'anna'
+
+A_DELIMITER_END = '-A--'
+READ_BLOCK_SIZE = 1024 * 1024
+QUEUE_BLOCKS = 8
+BGZF_BATCH = 64
+BGZF_HEADER = struct.Struct('<4s6xH2sHH')
+DECOMPRESS_THREADS = multiprocessing.cpu_count()
+
+COMPRESSED_EXTENSIONS = ('.gz', '.bz2', '.xz', '.zst')
+DECOMPRESSION_ERRORS = ((zlib.error,) + ((lzma.LZMAError,) if lzma else ()) +
+                        ((zstandard.ZstdError,) if zstandard else ()))
+
+
+def is_compressed(filename):
+    return os.path.splitext(filename)[1] in COMPRESSED_EXTENSIONS
+
+
+def is_mappable(filename):
+    """
+    :return: True if 'filename' is a regular, non-empty file that isn't compressed. A file
+    that can't be read isn't; opening it reports the error.
+    """
+    if filename == '-' or is_compressed(filename):
+        return False
+    try:
+        return os.path.getsize(filename) > 0
+    except OSError:
+        return False
+
+
+def find_message(data, position, end):
+    """
+    Find the next A section delimiter in data[position:end].
+    :param data: String or mmap
+    :param position: Offset of the start of a line
+    :return: Offset of the delimiter line, or 'end' if there is none
+    """
+    while True:
+        i = data.find(A_DELIMITER_END, position, end)
+        if i < 0:
+            return end
+        line_start = max(position, data.rfind('\n', 0, i) + 1)
+        result = ModSecurityLog.DELIMITER_PATTERN.match(data, line_start, end)
+        if result and result.group(2) == 'A' and result.end() == i + len(A_DELIMITER_END):
+            return line_start
+        position = i + len(A_DELIMITER_END)
+
+
+def iter_messages(data, start, end):
+    """
+    Yield (start, end) of each message in data[start:end]. 'start' must be the start of a line.
+    Anything before the first A section delimiter is skipped.
+    """
+    position = find_message(data, start, end)
+    while position < end:
+        following = find_message(data, position + 1, end)
+        yield position, following
+        position = following
+
+
+def gzip_decompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def stream_blocks(f, new_decompressor):
+    """
+    Decompress the file 'f', made of one or more compressed streams, like gzip members.
+    :param new_decompressor: Creates an object with decompress(data) and unused_data for one stream
+    :return: Iterator over blocks of decompressed data
+    """
+    decompressor = new_decompressor()
+    started = False
+    while True:
+        data = f.read(READ_BLOCK_SIZE)
+        if not data:
+            return
+        while data:
+            if not started:
+                data = data.lstrip('\x00')  # Padding between or after streams
+                if not data:
+                    break
+                started = True
+            try:
+                block = decompressor.decompress(data)
+                data = decompressor.unused_data
+            except EOFError:  # bz2 and lzma at the end of a stream. 'data' belongs to the next one.
+                block = ''
+            if block:
+                yield block
+            if data:
+                decompressor = new_decompressor()
+                started = False
+
+
+def zstd_blocks(f):
+    reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+    while True:
+        block = reader.read(READ_BLOCK_SIZE)
+        if not block:
+            return
+        yield block
+
+
+def is_bgzf(header):
+    """
+    :param header: The first BGZF_HEADER.size bytes of a file
+    :return: True if the file starts with a BGZF block: a gzip member with its size in a 'BC' extra field
+    """
+    if len(header) < BGZF_HEADER.size:
+        return False
+    magic, extra_length, subfield, subfield_length, _ = BGZF_HEADER.unpack(header)
+    return magic == '\x1f\x8b\x08\x04' and subfield == 'BC' and subfield_length == 2
+
+
+def decompress_member(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def bgzf_blocks(f):
+    """
+    Decompress BGZF_BATCH blocks at a time, in a pool of DECOMPRESS_THREADS threads.
+    zlib doesn't hold the interpreter lock while it decompresses, so the threads run in parallel.
+    """
+    pool = ThreadPool(DECOMPRESS_THREADS)
+    try:
+        while True:
+            members = list()
+            while len(members) < BGZF_BATCH:
+                header = f.read(BGZF_HEADER.size)
+                if not header:
+                    break
+                if not is_bgzf(header):
+                    raise IOError('Not a BGZF block at offset %d' % (f.tell() - len(header)))
+                size = BGZF_HEADER.unpack(header)[4] + 1
+                members.append(header + f.read(size - len(header)))
+            if not members:
+                return
+            for block in pool.map(decompress_member, members):
+                if block:
+                    yield block
+    finally:
+        pool.terminate()
+
+
+def file_blocks(filename):
+    """
+    :return: Iterator over blocks of decompressed data from the compressed file 'filename'
+    """
+    extension = os.path.splitext(filename)[1]
+    with open(filename, 'rb') as f:
+        if extension == '.gz':
+            bgzf = is_bgzf(f.read(BGZF_HEADER.size))
+            f.seek(0)
+            blocks = bgzf_blocks(f) if bgzf else stream_blocks(f, gzip_decompressor)
+        elif extension == '.bz2':
+            blocks = stream_blocks(f, bz2.BZ2Decompressor)
+        elif extension == '.xz':
+            if lzma is None:
+                raise IOError('Reading %s needs the lzma module (pip install backports.lzma)' % filename)
+            blocks = stream_blocks(f, lzma.LZMADecompressor)
+        elif extension == '.zst':
+            if zstandard is None:
+                raise IOError('Reading %s needs the zstandard module (pip install zstandard)' % filename)
+            blocks = zstd_blocks(f)
+        else:
+            raise IOError('Unknown compression: %s' % filename)
+        try:
+            for block in blocks:
+                yield block
+        except DECOMPRESSION_ERRORS as e:
+            raise IOError('{0:s}: {1:s}'.format(filename, e))
+
+
+class Prefetcher(threading.Thread):
+    """
+    Produce the items of 'blocks' in a background thread, up to QUEUE_BLOCKS ahead of the consumer.
+    Iterate over the Prefetcher to get them.
+    """
+
+    def __init__(self, blocks):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.blocks = blocks
+        self.queue = Queue.Queue(QUEUE_BLOCKS)
+        self.stopped = False
+
+    def run(self):
+        try:
+            for block in self.blocks:
+                if not self.put((block, None)):
+                    return
+            self.put((None, None))
+        except Exception as e:
+            self.put((None, e))
+        finally:
+            self.blocks.close()
+
+    def put(self, item):
+        """
+        :return: False if the consumer has stopped
+        """
+        while not self.stopped:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        self.start()
+        try:
+            while True:
+                # A timeout keeps the wait interruptible with Ctrl-C on Python 2
+                block, error = self.queue.get(True, 365 * 24 * 3600)
+                if error is not None:
+                    raise error
+                if block is None:
+                    return
+                yield block
+        finally:
+            self.stopped = True
+
+
+def block_lines(blocks, start=0, end=None):
+    """
+    Yield the lines in 'blocks' of data, from offset 'start' up to 'end'. 'start' must be the start of a line.
+
+    >>> list(block_lines(['ab\\nc', 'd\\ne\\n', 'f']))
+    ['ab\\n', 'cd\\n', 'e\\n', 'f']
+    >>> list(block_lines(['ab\\nc', 'd\\ne\\n', 'f'], start=3, end=6))
+    ['cd\\n']
+    """
+    position = 0
+    pending = ''
+    for block in blocks:
+        if position < start:
+            if position + len(block) <= start:
+                position += len(block)
+                continue
+            block = block[start - position:]
+            position = start
+        data = pending + block
+        last = data.rfind('\n') + 1
+        pending = data[last:]
+        if end is not None and position + last >= end:
+            for line in StringIO(data[:last]):
+                if position >= end:
+                    return
+                position += len(line)
+                yield line
+            continue
+        for line in StringIO(data[:last]):
+            yield line
+        position += last
+    if pending and (end is None or position < end):
+        yield pending
+
+
+def read_lines(filename, start=0, end=None):
+    """
+    Yield the lines of 'filename', from byte offset 'start' up to 'end'.
+    Offsets in compressed files are offsets in the uncompressed data.
+    '-' (stdin) is always read from the beginning to the end.
+    """
+    if filename == '-':
+        for line in sys.stdin:
+            yield line
+        return
+    if is_compressed(filename):
+        for line in block_lines(Prefetcher(file_blocks(filename)), start, end):
+            yield line
+        return
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        if end is None:
+            for line in f:
+                yield line
+            return
+        position = start
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+
+def parse_file(log, filename, callback, start=0, end=None, first_line=1, line_numbers=True):
+    """
+    Parse 'filename', or the byte range [start, end) of it, with 'log'.
+
+    :param log: ModSecurityLog
+    :param callback: Called with each complete message
+    :param first_line: Line number of the line at 'start'
+    :param line_numbers: Count lines in memory mapped files. Without it, messages get line number 0.
+    """
+    if not is_mappable(filename):
+        for line_count, line in enumerate(read_lines(filename, start, end), first_line):
+            log.parse_line(line.strip(), line_count, callback=callback)
+        return
+
+    with open(filename, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if end is None:
+            end = len(data)
+        line_count = first_line
+        counted = start
+        for message_start, message_end in iter_messages(data, start, end):
+            if line_numbers:
+                line_count += data[counted:message_start].count('\n')
+                counted = message_start
+            log.parse_message(data, message_start, message_end, line_count if line_numbers else 0,
+                              callback=callback)
+    finally:
+        data.close()
@@ -0,0 +1,188 @@
+"""
+Merge the messages of several logs in time order, e.g. the logs of several
+WAF nodes, or the rotated parts of one log.
+
+Each log is parsed and formatted in a process of its own. The formatted
+messages are handed back in small batches through a bounded queue, and
+merged by their Section A timestamp with a heap that holds one pending
+message per log. Messages with the same timestamp keep the order of the
+logs on the command line, and the order within each log.
+
+A log whose first and last timestamps, read from its head and tail, are
+outside --since/--until is skipped without being parsed.
+
+"""
+import heapq
+import logreader
+import multiprocessing
+import os
+from cStringIO import StringIO
+from mod_security import Start
+from parallel import ignore_interrupts
+
+__author__ = 'anna'
+
+BATCH_MESSAGES = 64
+QUEUE_BATCHES = 4
+HEAD_TAIL_SIZE = 64 * 1024
+# Messages are logged when the request is done, but stamped with the time it started
+SPAN_SLACK = 5 * 60
+
+
+def start_lines(data):
+    """
+    :param data: Part of a log, starting at the start of a line
+    :return: The Section A lines of the complete messages in 'data'
+    """
+    lines = list()
+    for start, end in logreader.iter_messages(data, 0, len(data)):
+        eol = data.find('\n', start, end)
+        following = data.find('\n', eol + 1, end)
+        if eol >= 0 and following >= 0:
+            lines.append(data[eol + 1:following].strip())
+    return lines
+
+
+def time_span(filename):
+    """
+    Read the first and last Section A of 'filename', from its first and last HEAD_TAIL_SIZE bytes.
+    :return: (first, last) Start, or None if they can't be read, e.g. from a compressed file
+    """
+    if not logreader.is_mappable(filename):
+        return None
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        head = f.read(HEAD_TAIL_SIZE)
+        f.seek(max(0, size - HEAD_TAIL_SIZE))
+        tail = f.read()
+    if size > HEAD_TAIL_SIZE:
+        tail = tail[tail.find('\n') + 1:]
+    head_lines = start_lines(head)
+    tail_lines = start_lines(tail)
+    if not head_lines or not tail_lines:
+        return None
+    first = Start()
+    first.add(head_lines[0], 0)
+    last = Start()
+    last.add(tail_lines[-1], 0)
+    if first.get_datetime() is None or last.get_datetime() is None:
+        return None
+    return first, last
+
+
+def in_window(filename, since, until):
+    """
+    :param since: (seconds since epoch, has a timezone) from timestamps.parse_point, or None
+    :param until: Same as 'since'
+    :return: False if no message in 'filename' can be logged between 'since' and 'until'
+    """
+    if since is None and until is None:
+        return True
+    span = time_span(filename)
+    if span is None:
+        return True
+    first, last = span
+
+    def seconds(start, point):
+        return start.get_datetime() if point[1] else start.get_local_datetime()
+
+    if since is not None and seconds(last, since) + SPAN_SLACK < since[0]:
+        return False
+    if until is not None and seconds(first, until) - SPAN_SLACK > until[0]:
+        return False
+    return True
+
+
+def produce(log_class, args, filename, queue, line_numbers):
+    """
+    Parse 'filename' with a new 'log_class' instance, and put batches of (timestamp, formatted output)
+    on 'queue'. The last item is (None, log counters), or (error, None) if parsing failed.
+    """
+    ignore_interrupts()
+    try:
+        log = log_class(args)
+        output = StringIO()
+        handler = log.message_handler(output)
+        batch = list()
+
+        def handle(message):
+            handler(message)
+            if output.tell():
+                batch.append((message.start().get_datetime(), output.getvalue()))
+                output.seek(0)
+                output.truncate()
+                if len(batch) == BATCH_MESSAGES:
+                    queue.put(batch[:])
+                    del batch[:]
+
+        logreader.parse_file(log, filename, handle, line_numbers=line_numbers)
+        if batch:
+            queue.put(batch)
+        queue.put((None, log.get_counters()))
+    except Exception as e:
+        queue.put((e, None))
+
+
+def receive(queue):
+    """
+    Yield (timestamp, formatted output, None) for each message from 'queue', then (None, None, log counters).
+    """
+    while True:
+        # A timeout keeps the wait interruptible with Ctrl-C on Python 2
+        item = queue.get(True, 365 * 24 * 3600)
+        if not isinstance(item, list):
+            error, counters = item
+            if error is not None:
+                raise error
+            yield None, None, counters
+            return
+        for timestamp, output in item:
+            yield timestamp, output, None
+
+
+def merge(log_class, args, filenames, line_numbers=False):
+    """
+    Parse 'filenames', one process each, and merge their messages in time order.
+
+    :param log_class: ModSecurityLog subclass, created in each process from 'args'
+    :param args: Command line arguments for 'log_class'
+    :return: Iterator over (filename, formatted output, None) of each message, and
+    (filename, '', log counters) as each file ends
+    """
+    processes = list()
+    inputs = list()
+    try:
+        for filename in filenames:
+            queue = multiprocessing.Queue(QUEUE_BATCHES)
+            process = multiprocessing.Process(target=produce, args=(log_class, args, filename, queue, line_numbers))
+            process.daemon = True
+            process.start()
+            processes.append(process)
+            inputs.append(receive(queue))
+
+        heap = list()
+        for i in xrange(len(inputs)):
+            for item in advance(inputs, i, filenames, heap):
+                yield item
+        while heap:
+            _, i, output = heapq.heappop(heap)
+            yield filenames[i], output, None
+            for item in advance(inputs, i, filenames, heap):
+                yield item
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+
+def advance(inputs, i, filenames, heap):
+    """
+    Push the next message of input 'i' on 'heap'. Yields (filename, '', counters) if the input has ended.
+    """
+    timestamp, output, counters = next(inputs[i])
+    if output is not None:
+        heapq.heappush(heap, (timestamp, i, output))
+    else:
+        yield filenames[i], '', counters
@@ -0,0 +1,179 @@
+"""
+On-disk cache of parsed messages, for greplog --cache.
+
+Each log gets a file of its own in the cache directory, named after a hash
+of its full path. The file holds the parsed fields of every message (section
+A, method, URL, request headers and parameters, body parameters and response
+code) along with its offset. The records are serialized with marshal in
+chunks of CHUNK_MESSAGES, so that they can be read back a chunk at a time.
+
+A cache file is only used if the size and mtime of the log, and the body
+limits it was parsed with, are the same as when it was written. Using a
+cache file marks it as recently used, and when the files in the cache
+directory take up more than the size limit, the least recently used ones are
+removed.
+
+"""
+import hashlib
+import marshal
+import os
+import struct
+import tempfile
+import logreader
+from mod_security import Message, ModSecurityLog
+
+__author__ = 'anna'
+
+EXTENSION = '.mcache'
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'modsecurity-grep')
+DEFAULT_SIZE = 1024
+CHUNK_MESSAGES = 1024
+
+HEADER = struct.Struct('<8sQdqq')
+MAGIC = 'MSMSGC02'
+
+
+def file_signature(filename):
+    """
+    :return: (size, mtime) of 'filename'. The cache is stale if either changes.
+    """
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime
+
+
+class CacheMessage(Message):
+    """
+    Message parsed for the cache. 'args' is (max_body_size, max_parameters).
+    """
+    __slots__ = ()
+
+    def body_limits(self):
+        return self.args
+
+
+class MessageCache(object):
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_size=DEFAULT_SIZE):
+        """
+        :param max_size: Largest total size of the cache files, in MB
+        """
+        self.directory = directory
+        self.max_size = max_size * 1024 * 1024
+
+    def cache_filename(self, filename):
+        key = hashlib.sha1(os.path.realpath(filename)).hexdigest()
+        return os.path.join(self.directory, key + EXTENSION)
+
+    def parse_file(self, log, filename, callback, limits):
+        """
+        Like logreader.parse_file, but with messages from the cache. The cache is built
+        first if it's missing or stale. stdin is parsed as usual.
+
+        :param log: ModSecurityLog. Its message class must be able to do without raw lines.
+        :param limits: (max_body_size, max_parameters) of the messages
+        """
+        if filename == '-':
+            logreader.parse_file(log, filename, callback)
+            return
+        records = self.load(filename, limits)
+        if records is None:
+            self.build(filename, limits)
+            records = self.load(filename, limits)
+        if records is None:  # The cache directory isn't writable
+            logreader.parse_file(log, filename, callback)
+            return
+        message = log.message_class(0, log.args)
+        for record in records:
+            message.load(record)
+            callback(message)
+
+    def load(self, filename, limits):
+        """
+        :return: Iterator over the cached records of 'filename', or None if there are none or they are stale
+        """
+        name = self.cache_filename(filename)
+        try:
+            f = open(name, 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            magic, size, mtime, max_body_size, max_parameters = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or (size, mtime) != file_signature(filename) or \
+                    (max_body_size, max_parameters) != tuple(limits):
+                f.close()
+                return None
+            os.utime(name, None)
+        except (IOError, OSError, struct.error):
+            f.close()
+            return None
+        return self.read_records(f)
+
+    @staticmethod
+    def read_records(f):
+        with f:
+            while True:
+                try:
+                    chunk = marshal.load(f)
+                except EOFError:
+                    return
+                for record in chunk:
+                    yield record
+
+    def build(self, filename, limits):
+        """
+        Parse all messages in 'filename' and write them to its cache file.
+        Does nothing if the cache directory isn't writable.
+        """
+        size, mtime = file_signature(filename)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, temporary = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        except (IOError, OSError):
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, size, mtime, limits[0], limits[1]))
+                chunk = list()
+
+                def add(message):
+                    chunk.append(message.dump())
+                    if len(chunk) == CHUNK_MESSAGES:
+                        marshal.dump(chunk, f)
+                        del chunk[:]
+
+                log = ModSecurityLog(tuple(limits), message_class=CacheMessage, reuse_messages=True)
+                logreader.parse_file(log, filename, add)
+                if chunk:
+                    marshal.dump(chunk, f)
+            os.rename(temporary, self.cache_filename(filename))
+        except (IOError, OSError):
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+
+    def evict(self):
+        """
+        Remove the least recently used cache files until the rest fit in the size limit.
+        """
+        try:
+            names = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                     if name.endswith(EXTENSION)]
+        except OSError:
+            return
+        files = list()
+        for name in names:
+            try:
+                st = os.stat(name)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_size:
+                return
+            try:
+                os.remove(name)
+            except OSError:
+                continue
+            total -= size
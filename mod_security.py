@@ -6,6 +6,91 @@ import datetime
 __author__ = 'anna'
 from enum import Enum
 from collections import defaultdict
+from timestamps import SECONDS_PER_DAY, TimestampParser, parse_offset
+
+# Default limits for the request body: bytes kept, and parameters parsed from it
+MAX_BODY_SIZE = 1024 * 1024
+MAX_PARAMETERS = 1000
+
+JSON_DECODER = json.JSONDecoder()
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+QUERY_PAIR = re.compile(r'[^&;]+')
+
+
+def interned(param):
+    """
+    Copy of the name-values in 'param' with the strings interned, so that marshal writes
+    each distinct name or value once
+    """
+    return dict((intern(name) if type(name) is str else name,
+                 [intern(value) if type(value) is str else value for value in values] if type(values) is list else values)
+                for name, values in param.iteritems())
+
+
+def query_items(text):
+    """
+    Name-value pairs of a query string or form body, one at a time. Like urlparse.parse_qs,
+    pairs without a value are left out.
+
+    >>> list(query_items('a=1&b=&c&d=x+y;e=%41'))
+    [('a', '1'), ('d', 'x y'), ('e', 'A')]
+    """
+    for match in QUERY_PAIR.finditer(text):
+        name, _, value = match.group().partition('=')
+        if value:
+            yield urlparse.unquote(name.replace('+', ' ')), urlparse.unquote(value.replace('+', ' '))
+
+
+def json_value(text, position):
+    try:
+        return JSON_DECODER.scan_once(text, position)
+    except StopIteration:
+        raise ValueError('Expecting a value at {0:d}'.format(position))
+
+
+def json_items(text):
+    """
+    Name-value pairs of the JSON object in 'text', one at a time, so that the
+    caller can stop before the whole object has been decoded.
+    Raises ValueError when 'text' isn't a JSON object, after the pairs before the error.
+
+    >>> list(json_items('{"a": 1, "b": {"c": [2]}}'))
+    [(u'a', 1), (u'b', {u'c': [2]})]
+    >>> list(json_items('{}'))
+    []
+    >>> items = json_items('{"a": 1, "b"')
+    >>> next(items)
+    (u'a', 1)
+    >>> next(items)
+    Traceback (most recent call last):
+    ...
+    ValueError: Expecting ':' at 12
+    """
+    position = JSON_WHITESPACE.match(text).end()
+    if text[position:position + 1] != '{':
+        raise ValueError('Expecting an object at {0:d}'.format(position))
+    position = JSON_WHITESPACE.match(text, position + 1).end()
+    if text[position:position + 1] == '}':
+        position += 1
+    else:
+        while True:
+            if text[position:position + 1] != '"':
+                raise ValueError('Expecting a property name at {0:d}'.format(position))
+            name, position = json_value(text, position)
+            position = JSON_WHITESPACE.match(text, position).end()
+            if text[position:position + 1] != ':':
+                raise ValueError("Expecting ':' at {0:d}".format(position))
+            value, position = json_value(text, JSON_WHITESPACE.match(text, position + 1).end())
+            yield name, value
+            position = JSON_WHITESPACE.match(text, position).end()
+            delimiter = text[position:position + 1]
+            position = JSON_WHITESPACE.match(text, position + 1).end()
+            if delimiter == '}':
+                break
+            if delimiter != ',':
+                raise ValueError("Expecting ',' at {0:d}".format(position))
+    if JSON_WHITESPACE.match(text, position).end() != len(text):
+        raise ValueError('Extra data at {0:d}'.format(position))
 
 
 class LogParts(Enum):
@@ -40,6 +125,7 @@ class Parameters(object):
     Contains name-value pairs and a means to regex search in them.
     Used for e.g. HTTP parameters and request headers.
     """
+    __slots__ = ('param',)
 
     def __init__(self):
         self.param = defaultdict(list)
@@ -77,15 +163,15 @@ class Parameters(object):
     def matches(self, names_values):
         """
         All name-value pairs in 'name_values' must match
-        :param names_values Regular expressions to match keys & values with
+        :param names_values Compiled patterns (utils.Pattern) to match keys & values with
         """
         if not names_values:
             return True
         for re_k, re_v in names_values.iteritems():
             for k, v in self.param.iteritems():
-                if re.search(re_k, k):
+                if re_k.search(k):
                     if re_v:
-                        if not any(re.search(re_v, value) for value in v):
+                        if not any(re_v.search(value) for value in v):
                             return False
                     break
             else:  # no break
@@ -97,36 +183,155 @@ class Parameters(object):
 
 
 class Part(object):
-    """ Base class for mod_security log parts """
+    """ Base class for mod_security log parts.
+
+    Lines are stored as they are added, and parsed the first time something
+    asks for the parsed data (see 'parse'). After that the lines are only
+    kept if 'keep_raw' is set, i.e. if the raw content is shown or searched.
+
+    A part can be limited to 'max_size' bytes of lines and 'max_parameters'
+    parsed parameters. Whatever goes over a limit is skipped, and the part
+    is marked as 'truncated'.
+
+    Instead of lines, a part can be given a record of data that has already
+    been parsed (see 'dump' and 'load'), which is unpacked on first access.
+    """
+    __slots__ = ('raw_data', 'line_count', 'parameters', 'parsed', 'keep_raw',
+                 'size', 'max_size', 'parameter_count', 'max_parameters', 'truncated', 'record')
 
     def __init__(self):
         self.raw_data = []
         self.line_count = 0
         self.parameters = Parameters()
+        self.parsed = False
+        self.keep_raw = True
+        self.size = 0
+        self.max_size = None
+        self.parameter_count = 0
+        self.max_parameters = None
+        self.truncated = False
+        self.record = None
+
+    def reset(self):
+        """
+        Empty the part, so that it can be used for the next message
+        """
+        del self.raw_data[:]
+        self.line_count = 0
+        self.parameters.param.clear()
+        self.parsed = False
+        self.size = 0
+        self.parameter_count = 0
+        self.truncated = False
+        self.record = None
+
+    def room(self):
+        """
+        :return: How many more bytes of lines the part takes, or None if there is no limit
+        """
+        if self.max_size is None:
+            return None
+        return max(0, self.max_size - self.size)
 
     def add(self, line, line_count):
-        if not self.raw_data:
+        if self.max_size is not None:
+            room = self.room()
+            if len(line) > room:
+                self.truncated = True
+                line = line[:room]
+                if not line:
+                    return
+            self.size += len(line)
+        if not self.line_count:
             self.line_count = line_count
-        self.raw_data.append(line)
+        if self.parsed:
+            if self.keep_raw:
+                self.raw_data.append(line)
+            self.parse_line(line)
+        else:
+            self.raw_data.append(line)
+
+    def parse(self):
+        """
+        Parse the stored lines. Only done once, later calls do nothing.
+        """
+        if not self.parsed:
+            self.parsed = True
+            if self.record is not None:
+                self.restore(self.record)
+                self.record = None
+                return
+            for line in self.raw_data:
+                self.parse_line(line)
+            if not self.keep_raw:
+                del self.raw_data[:]
+
+    def dump(self):
+        """
+        :return: The parsed data, as values that marshal can write. See 'load'.
+        """
+        self.parse()
+        return interned(self.parameters.param), self.truncated
+
+    def load(self, record):
+        """
+        Give an empty part a record from 'dump', to use instead of parsing lines
+        """
+        self.record = record
+
+    def restore(self, record):
+        parameters, self.truncated = record
+        self.parameters.param.update(parameters)
+
+    def parse_line(self, line):
+        pass
+
+    def is_full(self):
+        """
+        :return: True if no more parameters can be added. The part is then truncated.
+        """
+        if self.max_parameters is not None and self.parameter_count >= self.max_parameters:
+            self.truncated = True
+            return True
+        return False
 
     def add_parameter(self, line):
-        for k, v in urlparse.parse_qs(line).iteritems():
-            self.parameters.add(k, v)
+        for k, v in query_items(line):
+            if self.is_full():
+                return
+            self.parameter_count += 1
+            self.parameters.add(k, [v])
 
     def add_json(self, line):
-        parameters = json.loads(line)
-        self.parameters.update(parameters)
+        """
+        Add the name-value pairs of the JSON object on 'line'.
+        Raises ValueError if 'line' isn't a JSON object, unless the part has been truncated,
+        e.g. in the middle of the object. Then the pairs up to the error are kept.
+        """
+        pairs = list()
+        try:
+            for pair in json_items(line):
+                if self.is_full():
+                    break
+                self.parameter_count += 1
+                pairs.append(pair)
+        except ValueError:
+            if not (self.truncated and pairs):
+                self.parameter_count -= len(pairs)
+                raise
+        self.parameters.update(pairs)
 
     def get_parameters(self):
+        self.parse()
         return self.parameters
 
     def extend(self, content):
         self.raw_data.extend(content)
 
-    def matches(self, regex):
-        if regex is None:
+    def matches(self, pattern):
+        if pattern is None:
             return True
-        return any([re.search(regex, line) for line in self.raw_data])
+        return any(pattern.search(line) for line in self.raw_data)
 
     def __str__(self):
         return "\n".join(self.raw_data)
@@ -149,90 +354,163 @@ class Start(Part):
                              \]
                              \s
                              (\S+)            # Random string
-                             \s([\d{1,3}\.]+) # IP
+                             \s(\S+)          # IP, v4 or v6
                              .*               # Ignore the rest of the string
                              """,
                          re.X)
 
     EPOCH = datetime.datetime(1970, 1, 1)
+    TIMESTAMPS = TimestampParser()
+
+    __slots__ = ('ip', 'datetime', 'utc_offset', 'timestamp', 'date', 'id', 'timezone')
 
     def __init__(self):
         Part.__init__(self)
         self.ip = None
         self.datetime = None
+        self.utc_offset = None
         self.timestamp = None
         self.date = None
         self.id = None
         self.timezone = None
 
-    def add(self, line, line_count):
-        result = re.match(self.PATTERN, line)
-        if result:
-
-            self.date = datetime.datetime.strptime(result.group(1), '%d/%b/%Y')
-            dt = datetime.datetime.strptime(result.group(2), '%H:%M:%S')
-
-            self.timestamp = datetime.time(dt.hour, dt.minute, dt.second, dt.microsecond)
-            self.datetime = int((datetime.datetime.combine(self.date, self.timestamp) - self.EPOCH).total_seconds())
+    def reset(self):
+        Part.reset(self)
+        self.ip = None
+        self.datetime = None
+        self.utc_offset = None
+        self.timestamp = None
+        self.date = None
+        self.id = None
+        self.timezone = None
 
-            self.timezone = result.group(3)  # but assuming UTC for now
+    def parse_line(self, line):
+        result = self.PATTERN.match(line)
+        if result:
+            self.timezone = result.group(3)
+            parsed = self.TIMESTAMPS.parse(result.group(1), result.group(2), self.timezone)
+            if parsed is not None:
+                self.datetime, self.utc_offset = parsed
             self.id = result.group(4)
             self.ip = result.group(5)
         else:
             print "No time match for", line
 
+    def dump(self):
+        self.parse()
+        return self.datetime, self.timezone, self.id, self.ip
+
+    def restore(self, record):
+        self.datetime, self.timezone, self.id, self.ip = record
+        self.utc_offset = (parse_offset(self.timezone) if self.timezone else None) or 0
+
     def __str__(self):
         return '{timestamp:s} : {ip:s}'.format(timestamp=self.format_timestamp(),
-                                               ip=self.ip)
+                                               ip=self.get_ip())
 
     def get_id(self):
+        self.parse()
         return self.id
 
     def get_ip(self):
+        self.parse()
         return self.ip
 
     def get_time(self):
+        """
+        :return: datetime.time, as written in the log
+        """
+        self.parse()
+        if self.timestamp is None and self.datetime is not None:
+            self.split_local_datetime()
         return self.timestamp
 
+    def get_datetime(self):
+        """
+        :return: Seconds since epoch
+        """
+        self.parse()
+        return self.datetime
+
+    def get_local_datetime(self):
+        """
+        :return: Seconds since epoch of the time as written in the log, as if it was in UTC
+        """
+        self.parse()
+        if self.datetime is None:
+            return None
+        return self.datetime + self.utc_offset
+
+    def get_time_of_day(self):
+        """
+        :return: Seconds since midnight, as written in the log
+        """
+        local = self.get_local_datetime()
+        return None if local is None else local % SECONDS_PER_DAY
+
+    def split_local_datetime(self):
+        dt = self.EPOCH + datetime.timedelta(seconds=self.datetime + self.utc_offset)
+        self.date = datetime.datetime(dt.year, dt.month, dt.day)
+        self.timestamp = dt.time()
+
     def format_date(self):
-        return self.date.strftime('%Y-%m-%d')
+        return self.get_date().strftime('%Y-%m-%d')
 
     def format_time(self):
-        return self.timestamp.strftime('%H:%M:%S')
+        return self.get_time().strftime('%H:%M:%S')
 
     def format_timestamp(self):
         return '{date:s} {timestamp:s}'.format(date=self.format_date(),
                                                timestamp=self.format_time())
 
     def get_date(self):
+        """
+        :return: datetime.datetime at midnight of the date as written in the log
+        """
+        self.parse()
+        if self.date is None and self.datetime is not None:
+            self.split_local_datetime()
         return self.date
 
     def ip_matches(self, ip):
-        return re.match(ip, self.ip)
+        return ip.match(self.get_ip())
 
-    def time_matches(self, timestamp):
-        if not timestamp:
+    def time_matches(self, time_of_day):
+        """
+        :param time_of_day: Seconds since midnight
+        """
+        if time_of_day is None:
             return True
-        return self.timestamp == timestamp
+        return self.get_time_of_day() == time_of_day
 
     def time_between(self, between):
+        """
+        :param between: (first, last) seconds since midnight
+        """
         if not between:
             return True
         start, end = between
-        return start <= self.timestamp <= end
+        time_of_day = self.get_time_of_day()
+        return time_of_day is not None and start <= time_of_day <= end
 
 
 class Headers(Part):
+    __slots__ = ('headers',)
 
     def __init__(self):
         Part.__init__(self)
         self.headers = Parameters()
 
-    def add(self, line, line_count):
+    def reset(self):
+        Part.reset(self)
+        self.headers.param.clear()
+
+    def parse_line(self, line):
         key, value = line.split(':', 1)
         self.headers.add(key, [value.strip()])
 
     def get_headers(self):
+        self.parse()
         return self.headers
 
 
@@ -243,13 +521,19 @@ class RequestHeaders(Headers):
     """
     QS = re.compile("(GET|POST|PUT|DELETE|HEAD|OPTIONS) ([^\s\?]+)(\??(\S*))")
 
+    __slots__ = ('_method', 'request_url')
+
     def __init__(self):
         super(RequestHeaders, self).__init__()
         self._method = None
         self.request_url = ""
 
-    def add(self, line, line_count):
-        Part.add(self, line, line_count)
+    def reset(self):
+        Headers.reset(self)
+        self._method = None
+        self.request_url = ""
+
+    def parse_line(self, line):
         result = re.match(self.QS, line)
         if result:
             if line.startswith('GET'):
@@ -267,64 +551,190 @@ class RequestHeaders(Headers):
             self.parameters.update(urlparse.parse_qs(result.group(4)).iteritems())
             self.request_url = (result.group(2), result.group(4))
         else:
-            Headers.add(self, line, line_count)
+            Headers.parse_line(self, line)
+
+    def dump(self):
+        self.parse()
+        return (self._method.name if self._method else None, self.request_url,
+                interned(self.headers.param), interned(self.parameters.param))
+
+    def restore(self, record):
+        method, self.request_url, headers, parameters = record
+        self._method = Methods[method] if method else None
+        self.headers.param.update(headers)
+        self.parameters.param.update(parameters)
 
     def get_method(self):
+        self.parse()
         return self._method
 
     def get_path(self):
+        self.parse()
         return self.request_url[0]
 
     def get_query_string(self):
+        self.parse()
         return self.request_url[1]
 
     def get_url(self):
+        self.parse()
         return "{}{}{}".format(self.request_url[0], '?' if self.request_url[1] else '', self.request_url[1])
 
 
 class ResponseHeaders(Headers):
     RS = re.compile("(\w+)/(.*) (\d\d\d) (.*)")
 
+    __slots__ = ('response_code', 'response')
+
     def __init__(self):
         super(ResponseHeaders, self).__init__()
         self.response_code = 0
         self.response = None
 
-    def add(self, line, line_count):
+    def reset(self):
+        Headers.reset(self)
+        self.response_code = 0
+        self.response = None
+
+    def parse_line(self, line):
         result = self.RS.match(line)
         if result:
             self.response_code = int(result.group(3))
             self.response = result.group(4)
         else:
-            Headers.add(self, line, line_count)
+            Headers.parse_line(self, line)
+
+    def dump(self):
+        self.parse()
+        return self.response_code, self.response, interned(self.headers.param)
+
+    def restore(self, record):
+        self.response_code, self.response, headers = record
+        self.headers.param.update(headers)
+
+    def get_response_code(self):
+        self.parse()
+        return self.response_code
 
 
 class Content(Part):
-    def add(self, line, line_count):
-        Part.add(self, line, line_count)
-        try:
-            self.add_json(line)
-        except ValueError:
-            self.add_parameter(line)
+    """
+    Request body. Lines that look like JSON objects are parsed as JSON, everything else as form data.
+    """
+    __slots__ = ()
+
+    def parse_line(self, line):
+        if self.is_full():
+            return
+        if line.startswith('{'):
+            try:
+                self.add_json(line)
+                return
+            except ValueError:
+                pass
+        self.add_parameter(line)
 
 
 class Ignore(Part):
+    __slots__ = ()
+
     def add(self, line, line_count):
         pass
 
+    def reset(self):
+        pass
+
+
+# Ignore keeps nothing, so all messages share one for the sections they don't care about
+IGNORE = Ignore()
+
 
 class Message(object):
+    """
+    One message in the log, made of its parts.
+
+    A Message can be reset and filled with the next message in the log
+    instead of creating a new one, see ModSecurityLog.
+    """
+    __slots__ = ('line_count', 'args', 'parts', 'parameters_merged', 'filters_passed',
+                 '_start', '_request_headers', '_content', '_response_headers')
+
+    # The parts that hold something, one of each per message
+    PART_CLASSES = (
+        (LogParts.STARTED, Start),
+        (LogParts.REQUEST_HEADERS, RequestHeaders),
+        (LogParts.CONTENT, Content),
+        (LogParts.RESPONSE_HEADERS, ResponseHeaders),
+    )
+
     def __init__(self, line_count, args):
         self.line_count = line_count
         self.args = args
-        self.parts = dict()
-        self.parts[LogParts.STARTED] = Start()
-        self.parts[LogParts.REQUEST_HEADERS] = RequestHeaders()
-        self.parts[LogParts.CONTENT] = Content()
-        self.parts[LogParts.IGNORE] = Ignore()
-        self.parts[LogParts.STOPPED] = Ignore()
-        self.parts[LogParts.RESPONSE_HEADERS] = ResponseHeaders()
-        self.parts[None] = Ignore()
+        self.parts = {LogParts.IGNORE: IGNORE, LogParts.STOPPED: IGNORE, None: IGNORE}
+        for state, part_class in self.PART_CLASSES:
+            part = self.parts[state] = part_class()
+            part.keep_raw = self.keeps_raw(state)
+        max_size, max_parameters = self.body_limits()
+        content = self.parts[LogParts.CONTENT]
+        content.max_size = max_size or None
+        content.max_parameters = max_parameters or None
+        # Looking the parts up by LogParts in 'parts' is slow with enum34, where enums are hashed in Python
+        self._start = self.parts[LogParts.STARTED]
+        self._request_headers = self.parts[LogParts.REQUEST_HEADERS]
+        self._content = content
+        self._response_headers = self.parts[LogParts.RESPONSE_HEADERS]
+        self.parameters_merged = False
+        self.filters_passed = None
+
+    def reset(self, line_count):
+        """
+        Empty the message, to be filled with the one starting at 'line_count'
+        """
+        self.line_count = line_count
+        self._start.reset()
+        self._request_headers.reset()
+        self._content.reset()
+        self._response_headers.reset()
+        self.parameters_merged = False
+        self.filters_passed = None
+
+    def dump(self):
+        """
+        :return: Line number and parsed data of all parts, as values that marshal can write
+        """
+        return (self.line_count, self.start().dump(), self.request_headers().dump(), self.content().dump(),
+                self.response_headers().dump())
+
+    def load(self, record):
+        """
+        Reset the message and fill it with a record from 'dump'
+        """
+        line_count, start, request_headers, content, response_headers = record
+        self.reset(line_count)
+        self._start.load(start)
+        self._request_headers.load(request_headers)
+        self._content.load(content)
+        self._response_headers.load(response_headers)
+
+    def keeps_raw(self, state):
+        """
+        :return: True if the lines of section 'state' are needed after it has been parsed,
+        e.g. to show the raw content
+        """
+        return False
+
+    def body_limits(self):
+        """
+        :return: (bytes, parameters) of the request body to keep and parse. 0 is no limit.
+        """
+        return MAX_BODY_SIZE, MAX_PARAMETERS
+
+    def accepts(self, state):
+        """
+        Early filtering hook, called when the 'state' section is complete.
+        :return: False if the message can't match, whatever the remaining sections contain
+        """
+        return True
 
     def method(self):
         return self.request_headers().get_method()
@@ -336,20 +746,42 @@ class Message(object):
         if line:
             self.parts[state].add(line, line_count)
 
+    def room(self, state):
+        """
+        :return: How many more bytes of lines section 'state' takes, or None if there is no limit
+        """
+        return self.parts[state].room()
+
+    def truncate(self, state):
+        self.parts[state].truncated = True
+
     def request_headers(self):
-        return self.parts[LogParts.REQUEST_HEADERS]
+        return self._request_headers
 
     def response_headers(self):
-        return self.parts[LogParts.RESPONSE_HEADERS]
+        return self._response_headers
 
     def content(self):
-        return self.parts[LogParts.CONTENT]
+        return self._content
 
     def start(self):
-        return self.parts[LogParts.STARTED]
+        return self._start
+
+    def parameters(self):
+        """
+        Content parameters, updated with the query string parameters.
+        The merge is only done the first time it's needed.
+        """
+        content_params = self.content().get_parameters()
+        if not self.parameters_merged:
+            content_params.update(self.request_headers().get_parameters())
+            self.parameters_merged = True
+        return content_params
 
 
 class FormattedMessage(Message):
+    __slots__ = ()
+
     def format_start(self):
         pass
 
@@ -370,44 +802,149 @@ class ModSecurityLog(object):
 
     DELIMITER_PATTERN = re.compile("--(\w+)-(\w)--")
 
-    def __init__(self, args, message_class=Message):
-        self.state = LogParts.IGNORE
+    SECTIONS = {
+        'A': LogParts.STARTED,
+        'B': LogParts.REQUEST_HEADERS,
+        'C': LogParts.CONTENT,
+        'I': LogParts.CONTENT,
+        'F': LogParts.RESPONSE_HEADERS,
+        'Z': LogParts.STOPPED,
+    }
+
+    # Sections after which Message.accepts gets a chance to reject the message
+    EARLY_FILTER_STATES = frozenset([LogParts.STARTED, LogParts.REQUEST_HEADERS])
+
+    # Sections with lines that are added to the message
+    PARSED_STATES = frozenset([LogParts.STARTED, LogParts.REQUEST_HEADERS, LogParts.CONTENT,
+                               LogParts.RESPONSE_HEADERS])
+
+    def __init__(self, args, message_class=Message, reuse_messages=False):
+        """
+        :param reuse_messages: Reset and reuse the same Message for every message in the log.
+        Only for callbacks that are done with a message when they return.
+        """
         self.message_class = message_class
         self.args = args
-        self.message = self.message_class(0, self.args)
+        self.reuse_messages = reuse_messages
+        self.message = None
         self.state = None
+        self.skipping = False
+        self.in_message = False
+
+    def message_handler(self, stream):
+        """
+        :return: Callback for complete messages, writing the ones to show to 'stream'
+        """
+        return self.message_class.message_handler_factory(stream)
+
+    def get_counters(self):
+        """
+        :return: Picklable counters describing the work done so far, see add_counters
+        """
+        return None
+
+    def add_counters(self, counters):
+        """
+        Add counters from another instance, e.g. one that parsed part of the log in another process
+        """
+        pass
+
+    def accepts_raw(self, data, start, end):
+        """
+        Early filtering hook, called with the whole unparsed message data[start:end] by parse_message.
+        :return: False if the message can't match
+        """
+        return True
 
     def parse_state(self, result, line_count):
         log_part = result.group(2)
         if log_part == 'A':
-            self.message = self.message_class(line_count, self.args)
-            self.state = LogParts.STARTED
-        elif log_part == 'B':
-            self.state = LogParts.REQUEST_HEADERS
-        elif log_part == 'C' or log_part == 'I':
-            self.state = LogParts.CONTENT
-        elif log_part == 'F':
-            self.state = LogParts.RESPONSE_HEADERS
-        elif log_part == 'Z':
-            self.state = LogParts.STOPPED
-        else:
-            self.state = LogParts.IGNORE
+            if self.reuse_messages and self.message is not None:
+                self.message.reset(line_count)
+            else:
+                self.message = self.message_class(line_count, self.args)
+            self.skipping = False
+            self.in_message = True
+        self.state = self.SECTIONS.get(log_part, LogParts.IGNORE)
 
     def parse_line(self, line, line_count, callback=None):
         """
         Parse log line, handle depending on current state.
 
         yields output, one line at a time.
+
+        A Z section delimiter without an A section before it (e.g. when starting in
+        the middle of a message) is ignored.
+
+        Once a message has been rejected by Message.accepts, everything up to
+        the next A section delimiter is skipped.
         """
+        if self.skipping and not line.endswith('-A--'):
+            return
 
         result = self.DELIMITER_PATTERN.match(line)
 
         if result:
+            if (self.state in self.EARLY_FILTER_STATES and result.group(2) != 'A'
+                    and not self.message.accepts(self.state)):
+                self.skipping = True
+                self.state = LogParts.IGNORE
+                return
             self.parse_state(result, line_count)
-        elif line:
+        elif line and self.in_message:
             self.message.add(self.state, line, line_count)
 
         if self.state == LogParts.STOPPED:
-            if callback is not None:
+            if callback is not None and self.in_message:
                 callback(self.message)
+            self.in_message = False
             self.state = LogParts.IGNORE
+
+    def parse_message(self, data, start, end, line_count, callback=None):
+        """
+        Parse one whole message, data[start:end], starting with its A section delimiter.
+
+        'data' can be a string or an mmap. Only the sections that are added to the
+        message are copied out of 'data' and split into lines, everything else is
+        just searched for the next delimiter. A section with a size limit (see
+        Part.room) is only copied up to the limit. All parts get 'line_count' as
+        their line number.
+
+        A message rejected by accepts_raw is skipped without parsing any of it.
+        """
+        self.state = None
+        if not self.accepts_raw(data, start, end):
+            return
+        position = start
+        while position < end:
+            eol = data.find('\n', position, end)
+            if eol < 0:
+                eol = end
+            following = data.find('\n--', eol, end)
+            following = end if following < 0 else following + 1
+
+            result = self.DELIMITER_PATTERN.match(data, position, eol)
+            if result:
+                if (self.state in self.EARLY_FILTER_STATES
+                        and not self.message.accepts(self.state)):
+                    self.state = LogParts.IGNORE
+                    return
+                self.parse_state(result, line_count)
+                if self.state == LogParts.STOPPED:
+                    if callback is not None:
+                        callback(self.message)
+                    self.in_message = False
+                    self.state = LogParts.IGNORE
+                    return
+                position = eol + 1
+            if self.state in self.PARSED_STATES and position < following:
+                stop = following
+                room = self.message.room(self.state)
+                if room is not None and following - position > room:
+                    stop = position + room
+                    self.message.truncate(self.state)
+                for line in data[position:stop].split('\n'):
+                    line = line.strip()
+                    if line:
+                        self.message.add(self.state, line, line_count)
+            position = following
@@ -0,0 +1,112 @@
+"""
+Write output from a background thread, so parsing doesn't wait for a slow reader.
+
+"""
+import Queue
+import contextlib
+import threading
+
+__author__ = 'anna'
+
+BUFFER_SIZE = 256 * 1024
+QUEUE_BUFFERS = 16
+WAIT_INTERVAL = 0.1
+
+
+class BackgroundWriter(object):
+    """
+    File-like object that collects what is written in buffers of 'buffer_size' bytes,
+    and writes them to 'stream' from a background thread. At most 'queue_size' buffers
+    wait to be written; after that, write() waits for the stream.
+
+    If writing to 'stream' fails, e.g. because the pager has quit, the IOError is raised by
+    the next call to write(), flush() or close(), as if the stream had been written directly.
+    """
+
+    def __init__(self, stream, buffer_size=BUFFER_SIZE, queue_size=QUEUE_BUFFERS):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.pending = list()
+        self.pending_size = 0
+        self.queue = Queue.Queue(queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            try:
+                if data is None:
+                    return
+                if self.error is None:
+                    self.stream.write(data)
+            except IOError as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, data):
+        # Waiting with a timeout keeps Ctrl-C working on Python 2
+        while True:
+            self.check()
+            try:
+                self.queue.put(data, timeout=WAIT_INTERVAL)
+                return
+            except Queue.Full:
+                pass
+
+    def write(self, text):
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.pending_size >= self.buffer_size:
+            self.put(''.join(self.pending))
+            self.pending = list()
+            self.pending_size = 0
+
+    def flush(self):
+        """
+        Wait until everything written so far has been written to the stream.
+        """
+        if self.pending:
+            self.put(''.join(self.pending))
+            self.pending = list()
+            self.pending_size = 0
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                self.queue.all_tasks_done.wait(WAIT_INTERVAL)
+        self.check()
+        self.stream.flush()
+
+    def close(self, discard=False):
+        """
+        Write what's left, unless 'discard' is set, and stop the thread. The stream is left open.
+        """
+        try:
+            if not discard:
+                self.flush()
+        finally:
+            self.pending = list()
+            self.error = self.error or IOError('Closed')  # Anything still queued is dropped
+            self.queue.put(None)
+            self.thread.join()
+
+
+@contextlib.contextmanager
+def background(stream):
+    """
+    Write to 'stream' through a BackgroundWriter. What's left is written at the end,
+    or thrown away if there's an exception (e.g. KeyboardInterrupt).
+    """
+    writer = BackgroundWriter(stream)
+    try:
+        yield writer
+    except BaseException:
+        writer.close(discard=True)
+        raise
+    writer.close()
@@ -0,0 +1,191 @@
+"""
+Scan large audit logs with several processes.
+
+Each file is split into byte ranges that start on an A section delimiter, so
+every range holds whole messages. The ranges are parsed in a process pool and
+the formatted output is handed back in file order.
+
+Ranges are at most MAX_CHUNK_SIZE bytes, however large the file, and only a
+few more ranges than there are processes are handed out ahead of the output
+being written. Memory use stays the same for any size of log, and output is
+written as soon as the range it's in is done.
+
+Directories of small files, such as concurrent audit logs, are parsed in
+batches of whole files instead.
+
+"""
+import collections
+import logreader
+import multiprocessing
+import os
+import signal
+from cStringIO import StringIO
+from mod_security import ModSecurityLog
+
+__author__ = 'anna'
+
+BLOCK_SIZE = 1024 * 1024
+MIN_CHUNK_SIZE = 4 * BLOCK_SIZE
+MAX_CHUNK_SIZE = 32 * BLOCK_SIZE
+CHUNKS_PER_JOB = 4
+# Tasks handed out per process ahead of the result being used
+TASKS_AHEAD = 2
+# A timeout keeps the wait interruptible with Ctrl-C on Python 2
+RESULT_TIMEOUT = 365 * 24 * 3600
+MAX_FILES_PER_BATCH = 256
+
+
+def next_message_offset(f, offset):
+    """
+    Find the first A section delimiter at or after 'offset'.
+    :param f: File opened in binary mode
+    :return: Byte offset of the delimiter line, or the file size if there is none
+    """
+    f.seek(offset)
+    if offset > 0:
+        offset += len(f.readline())  # Skip the partial line
+    while True:
+        line = f.readline()
+        if not line:
+            return offset
+        result = ModSecurityLog.DELIMITER_PATTERN.match(line)
+        if result and result.group(2) == 'A':
+            return offset
+        offset += len(line)
+
+
+def split_file(filename, jobs):
+    """
+    Split 'filename' in byte ranges that start on message boundaries. There are enough ranges to
+    keep 'jobs' processes busy, and ranges are at most about MAX_CHUNK_SIZE bytes.
+    :return: list of (start, end). 'end' is None for files that can't be split.
+    """
+    if not logreader.is_mappable(filename):
+        return [(0, None)]
+    size = os.path.getsize(filename)
+    count = max(1, min(jobs * CHUNKS_PER_JOB, size // MIN_CHUNK_SIZE), -(-size // MAX_CHUNK_SIZE))
+    offsets = [0]
+    with open(filename, 'rb') as f:
+        for i in xrange(1, count):
+            offset = next_message_offset(f, max(offsets[-1], size * i // count))
+            if offset > offsets[-1]:
+                offsets.append(offset)
+    offsets.append(size)
+    return zip(offsets[:-1], offsets[1:])
+
+
+def count_lines(task):
+    """
+    :return: Number of lines in the byte range. Ranges without an end are whole files, and not counted.
+    """
+    filename, start, end = task
+    if end is None:
+        return 0
+    lines = 0
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            lines += block.count('\n')
+            remaining -= len(block)
+    return lines
+
+
+def scan_chunk(task):
+    """
+    Parse one byte range with a new 'log_class' instance.
+    :return: (filename, formatted output, log counters)
+    """
+    log_class, args, filename, start, end, first_line, line_numbers = task
+    log = log_class(args)
+    output = StringIO()
+    handler = log.message_handler(output)
+    logreader.parse_file(log, filename, handler, start, end, first_line, line_numbers)
+    return filename, output.getvalue(), log.get_counters()
+
+
+def scan_batch(task):
+    """
+    Parse several whole files with one new 'log_class' instance.
+    :return: (list of (filename, formatted output), log counters)
+    """
+    log_class, args, filenames, line_numbers = task
+    log = log_class(args)
+    outputs = list()
+    for filename in filenames:
+        output = StringIO()
+        handler = log.message_handler(output)
+        logreader.parse_file(log, filename, handler, line_numbers=line_numbers)
+        outputs.append((filename, output.getvalue()))
+    return outputs, log.get_counters()
+
+
+def ignore_interrupts():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def ordered_results(pool, function, tasks, ahead):
+    """
+    Like pool.imap, but with at most 'ahead' tasks handed out before their results are used,
+    so results don't pile up in memory when they're used slower than they're made.
+    :return: Iterator over the results of 'function' for each of 'tasks', in order
+    """
+    pending = collections.deque()
+    for task in tasks:
+        if len(pending) >= ahead:
+            yield pending.popleft().get(RESULT_TIMEOUT)
+        pending.append(pool.apply_async(function, (task,)))
+    while pending:
+        yield pending.popleft().get(RESULT_TIMEOUT)
+
+
+def scan(log_class, args, filenames, jobs, line_numbers=False):
+    """
+    Parse 'filenames' in a pool of 'jobs' processes.
+
+    :param log_class: ModSecurityLog subclass, created in each process from 'args'
+    :param args: Command line arguments for 'log_class'
+    :param line_numbers: Count the lines before each range, so line numbers are correct
+    :return: Iterator over (filename, formatted output, log counters), in file order
+    """
+    pool = multiprocessing.Pool(jobs, initializer=ignore_interrupts)
+    try:
+        ranges = [(filename, start, end) for filename in filenames
+                  for (start, end) in split_file(filename, jobs)]
+        first_lines = [1] * len(ranges)
+        if line_numbers:
+            line_counts = pool.map(count_lines, ranges)
+            for i in xrange(1, len(ranges)):
+                if ranges[i][0] == ranges[i - 1][0]:
+                    first_lines[i] = first_lines[i - 1] + line_counts[i - 1]
+        tasks = [(log_class, args, filename, start, end, first_line, line_numbers)
+                 for (filename, start, end), first_line in zip(ranges, first_lines)]
+        for result in ordered_results(pool, scan_chunk, tasks, jobs * TASKS_AHEAD):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def scan_files(log_class, args, filenames, jobs, line_numbers=False):
+    """
+    Parse many small files in a pool of 'jobs' processes, a batch of files per task.
+
+    :param log_class: ModSecurityLog subclass, created in each process from 'args'
+    :param args: Command line arguments for 'log_class'
+    :return: Iterator over (list of (filename, formatted output), log counters), in the order of 'filenames'
+    """
+    size = max(1, min(MAX_FILES_PER_BATCH, len(filenames) // (jobs * CHUNKS_PER_JOB)))
+    tasks = [(log_class, args, filenames[i:i + size], line_numbers) for i in xrange(0, len(filenames), size)]
+    pool = multiprocessing.Pool(jobs, initializer=ignore_interrupts)
+    try:
+        for result in ordered_results(pool, scan_batch, tasks, jobs * TASKS_AHEAD):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,212 @@
+"""
+Where the time goes: per-stage timing for greplog --stats.
+
+Stages are timed by replacing functions and methods with timing wrappers
+when stats are turned on (Stats.install). Nothing is replaced otherwise, so
+there is no overhead without --stats.
+
+Time is counted for the innermost stage only: the time spent parsing headers
+inside a filter counts as header parsing, not as filtering.
+
+"""
+import inspect
+import logreader
+import os
+import resource
+import time
+from filters import FilterPlan, Prefilter
+from mod_security import (Content, Headers, Ignore, ModSecurityLog, Part, RequestHeaders, ResponseHeaders,
+                          Start)
+
+__author__ = 'anna'
+
+# The Stats instance that the timing wrappers report to
+ACTIVE = None
+
+# (object, attribute name) of everything that has been replaced by a timing wrapper
+INSTRUMENTED = set()
+
+# Instrumented in any program that uses stats
+STAGES = [
+    ('read', logreader, ['parse_file', 'read_lines']),
+    ('delimiters', logreader, ['find_message']),
+    ('delimiters', ModSecurityLog, ['parse_state']),
+    ('parse_line', ModSecurityLog, ['parse_line', 'parse_message']),
+    ('add', Part, ['add']),
+    ('add', Ignore, ['add']),
+    ('section A', Start, ['parse_line']),
+    ('headers', Headers, ['parse_line']),
+    ('headers', RequestHeaders, ['parse_line']),
+    ('headers', ResponseHeaders, ['parse_line']),
+    ('body', Content, ['parse_line']),
+    ('json body', Part, ['add_json']),
+    ('form body', Part, ['add_parameter']),
+    ('filter', FilterPlan, ['__call__']),
+    ('prefilter', Prefilter, ['__call__']),
+]
+
+
+def timed(stage, function):
+    """
+    :return: Wrapper around 'function' that adds the time spent in it to 'stage'.
+    Generator functions are timed while they produce each value.
+    """
+    if inspect.isgeneratorfunction(function):
+        def generator_wrapper(*args, **kwargs):
+            iterator = function(*args, **kwargs)
+            while True:
+                ACTIVE.enter()
+                try:
+                    value = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    ACTIVE.leave(stage)
+                yield value
+
+        return generator_wrapper
+
+    def wrapper(*args, **kwargs):
+        ACTIVE.enter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            ACTIVE.leave(stage)
+
+    return wrapper
+
+
+def instrument(target, names, stage):
+    """
+    Replace the functions or methods 'names' of the module or class 'target' with timing wrappers.
+    Each one is only replaced once, also if stats are turned on again.
+    """
+    for name in names:
+        if (target, name) in INSTRUMENTED:
+            continue
+        INSTRUMENTED.add((target, name))
+        attribute = vars(target)[name]
+        if isinstance(attribute, staticmethod):
+            setattr(target, name, staticmethod(timed(stage, attribute.__func__)))
+        else:
+            setattr(target, name, timed(stage, attribute))
+
+
+def peak_rss():
+    """
+    :return: Largest resident set size of this process so far, in bytes
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def file_size(filename, start, end):
+    """
+    :return: Number of bytes read from 'filename' for the range start to end. Unknown for stdin.
+    """
+    if end is not None:
+        return end - start
+    if filename == '-':
+        return 0
+    try:
+        return os.path.getsize(filename) - (0 if logreader.is_compressed(filename) else start)
+    except OSError:
+        return 0
+
+
+class TimedStream(object):
+    """
+    Time the writes to 'stream' as the 'output' stage.
+
+    The writes may come from the thread of an output.BackgroundWriter, so they are added
+    to the stage directly instead of going through the stack of the parsing thread.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        started = time.time()
+        try:
+            self.stream.write(data)
+        finally:
+            ACTIVE.add_time('output', time.time() - started)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class Stats(object):
+    def __init__(self):
+        self.times = dict()
+        self.bytes = 0
+        self.peak_rss = 0
+        self.started = time.time()
+        # Start time of each stage being timed, and the time spent in stages called from it
+        self.stack = list()
+
+    def install(self, stages=()):
+        """
+        Start timing the default STAGES and 'stages'.
+        :param stages: list of (stage, module or class, list of attribute names)
+        """
+        global ACTIVE
+        ACTIVE = self
+        for stage, target, names in STAGES + list(stages):
+            instrument(target, names, stage)
+        if (logreader, 'parse_file.bytes') not in INSTRUMENTED:
+            INSTRUMENTED.add((logreader, 'parse_file.bytes'))
+            parse_file = logreader.parse_file
+
+            def count_bytes(log, filename, callback, start=0, end=None, *args, **kwargs):
+                ACTIVE.bytes += file_size(filename, start, end)
+                return parse_file(log, filename, callback, start, end, *args, **kwargs)
+
+            logreader.parse_file = count_bytes
+
+    def enter(self):
+        self.stack.append([time.time(), 0.0])
+
+    def leave(self, stage):
+        started, inner = self.stack.pop()
+        elapsed = time.time() - started
+        self.times[stage] = self.times.get(stage, 0.0) + elapsed - inner
+        if self.stack:
+            self.stack[-1][1] += elapsed
+
+    def add_time(self, stage, seconds):
+        """
+        Add 'seconds' to 'stage', outside the stack of nested stages.
+        """
+        self.times[stage] = self.times.get(stage, 0.0) + seconds
+
+    def get_counters(self):
+        return self.times, self.bytes, max(self.peak_rss, peak_rss())
+
+    def add_counters(self, counters):
+        times, size, rss = counters
+        for stage, seconds in times.iteritems():
+            self.times[stage] = self.times.get(stage, 0.0) + seconds
+        self.bytes += size
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def report(self, stream, messages, matched, prefilter=None):
+        """
+        Write the time per stage, counts, throughput and peak memory to 'stream'.
+        :param prefilter: filters.Prefilter, to show how many messages it rejected
+        """
+        elapsed = time.time() - self.started
+        total = sum(self.times.itervalues())
+        stream.write('{0:<14s} {1:>10s} {2:>7s}\n'.format('stage', 'seconds', '%'))
+        for stage, seconds in sorted(self.times.iteritems(), key=lambda item: -item[1]):
+            stream.write('{0:<14s} {1:>10.3f} {2:>6.1f}%\n'.format(stage, seconds,
+                                                                    100.0 * seconds / total if total else 0))
+        stream.write('{0:<14s} {1:>10.3f}\n'.format('wall clock', elapsed))
+        stream.write('\n{0:d} messages seen, {1:d} matched, {2:.1f} MB read\n'.format(
+            messages, matched, self.bytes / 1024.0 / 1024))
+        if prefilter is not None and prefilter.evaluated:
+            stream.write('Prefilter rejected {0:d} of {1:d} messages ({2:.1f}%) before parsing\n'.format(
+                prefilter.rejected, prefilter.evaluated, 100.0 * prefilter.rejected / prefilter.evaluated))
+        if elapsed > 0:
+            stream.write('{0:.0f} messages/s, {1:.1f} MB/s\n'.format(messages / elapsed,
+                                                                     self.bytes / 1024.0 / 1024 / elapsed))
+        stream.write('Peak memory {0:.1f} MB\n'.format(max(self.peak_rss, peak_rss()) / 1024.0 / 1024))
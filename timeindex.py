@@ -0,0 +1,252 @@
+"""
+Sidecar index from Section A timestamps to byte offsets.
+
+The index is stored next to the log as <log>.timeidx. It holds one entry per
+block of BLOCK_MESSAGES messages: the byte offset and line number of the
+first message, and the lowest and highest timestamp in the block. Logs are
+mostly, but not strictly, in time order, so blocks are selected by their
+timestamp range rather than by the first timestamp alone.
+
+Timestamps are kept as written in the log, in seconds since epoch as if the
+log was in UTC, so that times of day can be looked up. The lowest and
+highest UTC offset in the log are kept as well, to look up points in time
+with a timezone.
+
+Offsets in compressed files are offsets in the uncompressed data. Python's
+zlib can't restart decompression in the middle of a stream, so a compressed
+log is still decompressed up to the first block, but nothing before it is
+parsed and reading stops after the last block.
+
+"""
+import bisect
+import os
+import struct
+import logreader
+from mod_security import ModSecurityLog, Start
+
+__author__ = 'anna'
+
+EXTENSION = '.timeidx'
+BLOCK_MESSAGES = 256
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Timestamp range of blocks where no timestamp could be read. Such blocks always match.
+UNKNOWN_LOWEST = -2 ** 63
+UNKNOWN_HIGHEST = 2 ** 63 - 1
+
+HEADER = struct.Struct('<8sQdIIQii')
+ENTRY = struct.Struct('<QQqq')
+MAGIC = 'MSTIDX02'
+
+
+def index_filename(filename):
+    return filename + EXTENSION
+
+
+def file_signature(filename):
+    """
+    :return: (size, mtime) of 'filename'. The index is stale if either changes.
+    """
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime
+
+
+def merge_ranges(ranges):
+    """
+    Join adjacent or overlapping (start, end, first line) byte ranges.
+
+    >>> merge_ranges([(0, 10, 1), (10, 20, 5), (30, 40, 9)])
+    [(0, 20, 1), (30, 40, 9)]
+    >>> merge_ranges([])
+    []
+    """
+    merged = list()
+    for start, end, line in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]), merged[-1][2])
+        else:
+            merged.append((start, end, line))
+    return merged
+
+
+def in_ranges(offset, ranges):
+    """
+    :param ranges: Sorted, non-overlapping (start, end, first line) byte ranges, as returned by merge_ranges
+    :return: True if 'offset' is in one of 'ranges'
+
+    >>> in_ranges(15, [(0, 10, 1), (10, 20, 5)])
+    True
+    >>> in_ranges(25, [(0, 10, 1), (30, 40, 5)])
+    False
+    """
+    i = bisect.bisect_right(ranges, (offset, UNKNOWN_HIGHEST, UNKNOWN_HIGHEST)) - 1
+    return i >= 0 and ranges[i][0] <= offset < ranges[i][1]
+
+
+class TimeIndex(object):
+    def __init__(self, filename, entries, size, mtime, end, utc_offsets=(0, 0)):
+        """
+        :param entries: list of (offset, line, lowest timestamp, highest timestamp), in file order
+        :param size: File size when the index was built
+        :param mtime: File modification time when the index was built
+        :param end: Offset of the end of the (uncompressed) data
+        :param utc_offsets: (lowest, highest) UTC offset of the timestamps, in seconds
+        """
+        self.filename = filename
+        self.entries = entries
+        self.size = size
+        self.mtime = mtime
+        self.end = end
+        self.utc_offsets = utc_offsets
+        # Highest timestamp up to and including each block, and lowest from each block on.
+        # Both are sorted, so the first and last candidate blocks can be found with bisect.
+        self.highest_before = list()
+        for entry in entries:
+            self.highest_before.append(max(entry[3], self.highest_before[-1]) if self.highest_before else entry[3])
+        self.lowest_after = list()
+        for entry in reversed(entries):
+            self.lowest_after.append(min(entry[2], self.lowest_after[-1]) if self.lowest_after else entry[2])
+        self.lowest_after.reverse()
+
+    @classmethod
+    def build(cls, filename):
+        """
+        Read the timestamps of all messages in 'filename'.
+        """
+        size, mtime = file_signature(filename)
+        entries = list()
+        offset = 0
+        line_count = 1
+        messages = 0
+        in_start = False
+        utc_offsets = None
+        for line in logreader.read_lines(filename):
+            stripped = line.strip()
+            result = ModSecurityLog.DELIMITER_PATTERN.match(stripped)
+            if result:
+                in_start = result.group(2) == 'A'
+                if in_start:
+                    if messages % BLOCK_MESSAGES == 0:
+                        entries.append([offset, line_count, None, None])
+                    messages += 1
+            elif in_start and stripped:
+                in_start = False
+                start = Start()
+                start.add(stripped, line_count)
+                timestamp = start.get_local_datetime()
+                if timestamp is not None:
+                    if utc_offsets is None:
+                        utc_offsets = (start.utc_offset, start.utc_offset)
+                    elif not utc_offsets[0] <= start.utc_offset <= utc_offsets[1]:
+                        utc_offsets = (min(utc_offsets[0], start.utc_offset), max(utc_offsets[1], start.utc_offset))
+                    entry = entries[-1]
+                    entry[2] = timestamp if entry[2] is None else min(entry[2], timestamp)
+                    entry[3] = timestamp if entry[3] is None else max(entry[3], timestamp)
+            offset += len(line)
+            line_count += 1
+        # Blocks without any readable timestamp can't be excluded
+        entries = [(o, l, UNKNOWN_LOWEST if lo is None else lo, UNKNOWN_HIGHEST if hi is None else hi)
+                   for o, l, lo, hi in entries]
+        return cls(filename, entries, size, mtime, offset, utc_offsets or (0, 0))
+
+    @classmethod
+    def load(cls, filename):
+        """
+        :return: The index for 'filename', or None if there is none or it's stale
+        """
+        try:
+            with open(index_filename(filename), 'rb') as f:
+                magic, size, mtime, block_messages, count, end, lowest_offset, highest_offset = \
+                    HEADER.unpack(f.read(HEADER.size))
+                if magic != MAGIC or block_messages != BLOCK_MESSAGES:
+                    return None
+                if (size, mtime) != file_signature(filename):
+                    return None
+                data = f.read(count * ENTRY.size)
+        except (IOError, OSError, struct.error):
+            return None
+        if len(data) != count * ENTRY.size:
+            return None
+        entries = [ENTRY.unpack_from(data, i * ENTRY.size) for i in xrange(count)]
+        return cls(filename, entries, size, mtime, end, (lowest_offset, highest_offset))
+
+    @classmethod
+    def get(cls, filename):
+        """
+        Load the index for 'filename', or build and save it if it's missing or stale.
+        """
+        index = cls.load(filename)
+        if index is None:
+            index = cls.build(filename)
+            index.save()
+        return index
+
+    def save(self):
+        """
+        Write the index next to the log. Does nothing if that isn't possible.
+        """
+        try:
+            with open(index_filename(self.filename), 'wb') as f:
+                f.write(HEADER.pack(MAGIC, self.size, self.mtime, BLOCK_MESSAGES, len(self.entries), self.end,
+                                    self.utc_offsets[0], self.utc_offsets[1]))
+                for entry in self.entries:
+                    f.write(ENTRY.pack(*entry))
+        except (IOError, OSError):
+            pass
+
+    def days(self):
+        """
+        :return: Start of each day (seconds since epoch) covered by the log
+        """
+        lowest = [entry[2] for entry in self.entries if entry[2] != UNKNOWN_LOWEST]
+        highest = [entry[3] for entry in self.entries if entry[3] != UNKNOWN_HIGHEST]
+        if not lowest or not highest:
+            return []
+        first_day = min(lowest) // SECONDS_PER_DAY
+        last_day = max(highest) // SECONDS_PER_DAY
+        return [day * SECONDS_PER_DAY for day in xrange(first_day, last_day + 1)]
+
+    def ranges(self, windows):
+        """
+        Byte ranges that hold all messages with timestamps in any of 'windows'.
+        :param windows: list of (first, last) seconds since epoch, inclusive
+        :return: list of (start, end, line number at start)
+        """
+        ranges = list()
+        for first, last in windows:
+            i = bisect.bisect_left(self.highest_before, first)
+            stop = bisect.bisect_right(self.lowest_after, last)
+            for j in xrange(i, stop):
+                offset, line, lowest, highest = self.entries[j]
+                if lowest <= last and highest >= first:
+                    end = self.entries[j + 1][0] if j + 1 < len(self.entries) else self.end
+                    ranges.append((offset, end, line))
+        return merge_ranges(ranges)
+
+    def time_of_day_ranges(self, first, last):
+        """
+        Byte ranges for messages logged between the times of day 'first' and 'last', on any day.
+        :param first: datetime.time
+        :param last: datetime.time
+        """
+        first = first.hour * 3600 + first.minute * 60 + first.second
+        last = last.hour * 3600 + last.minute * 60 + last.second
+        return self.ranges([(day + first, day + last) for day in self.days()])
+
+    def between_ranges(self, since, until):
+        """
+        Byte ranges for messages logged between two points in time.
+        :param since: (seconds since epoch, has a timezone) from timestamps.parse_point, or None
+        :param until: Same as 'since'
+        """
+        first = self.local_bound(since, 0) if since else UNKNOWN_LOWEST
+        last = self.local_bound(until, 1) if until else UNKNOWN_HIGHEST
+        return self.ranges([(first, last)])
+
+    def local_bound(self, point, which):
+        """
+        :return: 'point' as written in the log. A point with a timezone is moved by the lowest (which=0)
+        or highest (which=1) UTC offset in the log, so that no message is left out.
+        """
+        seconds, aware = point
+        return seconds + self.utc_offsets[which] if aware else seconds
@@ -0,0 +1,202 @@
+"""
+Section A timestamps, e.g. [01/Jun/2016:10:15:30 +0200], without strptime.
+
+Messages in a row share the date and the timezone offset, so the start of
+the day in seconds since epoch is only worked out when either of them
+changes. The time of day is added to it with integer arithmetic.
+
+Also parses the points in time given to --since and --until.
+
+"""
+import re
+
+__author__ = 'anna'
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+MONTHS = dict((name, number) for number, name in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1))
+
+UTC_NAMES = frozenset(['Z', 'UTC', 'GMT'])
+OFFSET_PATTERN = re.compile(r'([+-])(\d\d):?(\d\d)$')
+
+ISO_PATTERN = re.compile(r"""(\d{4})-(\d{1,2})-(\d{1,2})             # Date as Y-m-d
+                             (?:[T\s](\d{1,2}):(\d{2})(?::(\d{2}))?)?  # Time, with or without seconds
+                             \s*(\S+)?$                                # Timezone
+                             """, re.X)
+LOG_PATTERN = re.compile(r"""\[?(\d+)/(\w+)/(\d+)                        # Date as d/b/Y
+                             (?::(\d+):(\d+)(?::(\d+))?)?              # Time, with or without seconds
+                             \s*([^\s\]]+)?\]?$                        # Timezone
+                             """, re.X)
+
+
+def days_from_civil(year, month, day):
+    """
+    :return: Days since 1970-01-01 of a date in the Gregorian calendar
+
+    >>> days_from_civil(1970, 1, 1)
+    0
+    >>> days_from_civil(2016, 6, 1)
+    16953
+    >>> days_from_civil(2000, 2, 29) - days_from_civil(2000, 2, 28)
+    1
+    """
+    year -= month <= 2
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month - 3 if month > 2 else month + 9) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def days_in_month(year, month):
+    """
+    >>> days_in_month(2016, 2), days_in_month(1900, 2), days_in_month(2016, 6)
+    (29, 28, 30)
+    """
+    if month == 12:
+        return 31
+    return days_from_civil(year, month + 1, 1) - days_from_civil(year, month, 1)
+
+
+def parse_offset(zone):
+    """
+    :return: UTC offset of the timezone 'zone' in seconds, or None if it isn't one
+
+    >>> parse_offset('+0200')
+    7200
+    >>> parse_offset('-05:30')
+    -19800
+    >>> parse_offset('UTC')
+    0
+    >>> parse_offset('CEST') is None
+    True
+    """
+    if zone in UTC_NAMES:
+        return 0
+    result = OFFSET_PATTERN.match(zone)
+    if not result:
+        return None
+    sign, hours, minutes = result.groups()
+    offset = int(hours) * 3600 + int(minutes) * 60
+    return -offset if sign == '-' else offset
+
+
+class TimestampParser(object):
+    """
+    Parses the date, time and timezone of Section A, remembering the last date and timezone.
+
+    >>> parser = TimestampParser()
+    >>> parser.parse('01/Jun/2016', '10:15:30', '+0200')
+    (1464768930, 7200)
+    >>> parser.parse('01/Jun/2016', '10:15:31', '+0200')
+    (1464768931, 7200)
+    >>> parser.parse('31/Jun/2016', '10:15:31', '+0200') is None
+    True
+    """
+
+    def __init__(self):
+        self.date = None
+        self.zone = None
+        self.day = None
+        self.offset = None
+        self.time = None
+        self.time_of_day = None
+
+    def parse(self, date, time, zone):
+        """
+        :param date: d/b/Y
+        :param time: H:M:S
+        :param zone: UTC offset as +HHMM. Anything else is taken to be UTC.
+        :return: (seconds since epoch, UTC offset in seconds), or None if the date or time can't be read
+        """
+        if date != self.date or zone != self.zone:
+            if not self.set_day(date, zone):
+                return None
+        if time != self.time:
+            try:
+                hour, minute, second = time.split(':')
+                time_of_day = int(hour) * 3600 + int(minute) * 60 + int(second)
+            except ValueError:
+                return None
+            if not 0 <= time_of_day < SECONDS_PER_DAY:
+                return None
+            self.time, self.time_of_day = time, time_of_day
+        return self.day + self.time_of_day - self.offset, self.offset
+
+    def set_day(self, date, zone):
+        self.date = None
+        try:
+            day, month, year = date.split('/')
+            day, month, year = int(day), MONTHS[month], int(year)
+        except (ValueError, KeyError):
+            return False
+        if not 1 <= day <= days_in_month(year, month):
+            return False
+        self.day = days_from_civil(year, month, day) * SECONDS_PER_DAY
+        self.offset = parse_offset(zone) or 0
+        self.date, self.zone = date, zone
+        return True
+
+
+def seconds_of_day(time):
+    """
+    :param time: datetime.time
+    :return: Seconds since midnight
+
+    >>> import datetime
+    >>> seconds_of_day(datetime.time(10, 15, 30))
+    36930
+    """
+    return time.hour * 3600 + time.minute * 60 + time.second
+
+
+def parse_point(text, end=False):
+    """
+    Parse a point in time for --since or --until: YYYY-MM-DD[ HH:MM[:SS]][ +HHMM], or the
+    Section A format DD/Mon/YYYY[:HH:MM[:SS]][ +HHMM]. Without a timezone, it's the time
+    as written in the log.
+
+    :param end: Fill in what's left out with the end of the day or minute, instead of the start
+    :return: (seconds since epoch, True if a timezone was given). Without a timezone,
+    it's seconds since epoch as if the log was written in UTC.
+    :raise ValueError: If 'text' can't be read
+
+    >>> parse_point('2016-06-01 10:15:30 +0200')
+    (1464768930, True)
+    >>> parse_point('2016-06-01 10:15:30') == (1464768930 + 7200, False)
+    True
+    >>> parse_point('2016-06-01', end=True) == (1464739200 + 86399, False)
+    True
+    >>> parse_point('01/Jun/2016:10:15:30 +0200')
+    (1464768930, True)
+    >>> parse_point('yesterday')
+    Traceback (most recent call last):
+    ...
+    ValueError: Can't read the time 'yesterday'
+    """
+    text = text.strip()
+    result = ISO_PATTERN.match(text)
+    if result:
+        year, month, day, hour, minute, second, zone = result.groups()
+        year, month, day = int(year), int(month), int(day)
+    else:
+        result = LOG_PATTERN.match(text)
+        if not result or result.group(2) not in MONTHS:
+            raise ValueError("Can't read the time '%s'" % text)
+        day, month, year, hour, minute, second, zone = result.groups()
+        year, month, day = int(year), MONTHS[month], int(day)
+    offset = parse_offset(zone) if zone else 0
+    if not 1 <= month <= 12 or not 1 <= day <= days_in_month(year, month) or offset is None:
+        raise ValueError("Can't read the time '%s'" % text)
+    if hour is None:
+        time_of_day = SECONDS_PER_DAY - 1 if end else 0
+    else:
+        time_of_day = int(hour) * 3600 + int(minute) * 60
+        if second is not None:
+            time_of_day += int(second)
+        elif end:
+            time_of_day += 59
+        if int(hour) > 23 or int(minute) > 59 or (second is not None and int(second) > 59):
+            raise ValueError("Can't read the time '%s'" % text)
+    return days_from_civil(year, month, day) * SECONDS_PER_DAY + time_of_day - offset, zone is not None
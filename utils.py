@@ -1,7 +1,301 @@
 import re
+import sre_constants
+import sre_parse
 
 __author__ = 'anna'
 
+REGEX_SPECIAL = frozenset('.^$*+?{}[]\\|()')
+BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+# Anchors and lookarounds, which would see past the parts left by the patterns before them
+CONTEXT = re.compile(r'(?<!\[)\^|\$|\\[bBAZ]|\(\?<?[=!]')
+HIGHLIGHTER_CACHE_SIZE = 1000
+
+
+def parse_literal(pattern):
+    """ Find out if 'pattern' is a plain string, possibly anchored with ^ and $.
+    :param pattern: Regular expression
+    :returns (literal, anchored at start, anchored at end) or None if 'pattern' needs the regex engine
+
+    Example:
+    >>> parse_literal("Language")
+    ('Language', False, False)
+    >>> parse_literal(r"^10\.0\.1$")
+    ('10.0.1', True, True)
+    >>> parse_literal("en|da") is None
+    True
+    >>> parse_literal(r"\d+") is None
+    True
+    """
+    start = pattern.startswith('^')
+    end = pattern.endswith('$') and not pattern.endswith('\\$')
+    body = pattern[1 if start else 0:len(pattern) - 1 if end else len(pattern)]
+    literal = list()
+    escaped = False
+    for c in body:
+        if escaped:
+            if c.isalnum():
+                return None
+            literal.append(c)
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif c in REGEX_SPECIAL:
+            return None
+        else:
+            literal.append(c)
+    if escaped:
+        return None
+    return ''.join(literal), start, end
+
+
+def required_literals(pattern):
+    """ Find strings that any text matched by 'pattern' contains one of.
+    :param pattern: Regular expression
+    :returns list of strings, or None if there are none to be found
+
+    Example:
+    >>> required_literals("Language")
+    ['Language']
+    >>> required_literals(r"^10\.0\.1")
+    ['10.0.1']
+    >>> required_literals("user_[0-9]+_id")
+    ['user_']
+    >>> required_literals("en|da")
+    ['en', 'da']
+    >>> required_literals("(?i)lang") is None
+    True
+    >>> required_literals("[0-9]+") is None
+    True
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (sre_constants.error, OverflowError):
+        return None
+    if parsed.pattern.flags & re.IGNORECASE:
+        return None
+    return sequence_literals(list(parsed))
+
+
+def sequence_literals(items):
+    """
+    :param items: Parsed regular expression, from sre_parse
+    :return: The longest run of literal characters, or the longest run in each branch of an alternation
+    """
+    if len(items) == 1 and items[0][0] == sre_constants.BRANCH:
+        literals = list()
+        for branch in items[0][1][1]:
+            branch_literals = sequence_literals(list(branch))
+            if branch_literals is None:
+                return None
+            literals.extend(branch_literals)
+        return literals
+    longest = ''
+    run = list()
+    for op, argument in items + [(None, None)]:
+        if op == sre_constants.LITERAL and argument < 256:
+            run.append(chr(argument))
+        else:
+            if len(run) > len(longest):
+                longest = ''.join(run)
+            run = list()
+    return [longest] if longest else None
+
+
+class Pattern(object):
+    """ A regular expression compiled once. Plain strings are matched with
+    substring and equality checks instead of the regex engine.
+
+    Example:
+    >>> Pattern("Lang").search("Accept-Language")
+    True
+    >>> Pattern("^Lang").search("Accept-Language")
+    False
+    >>> Pattern("10.0.1").match("10.0.1.12")
+    True
+    >>> Pattern("0.1").match("10.0.1.12")
+    False
+    >>> Pattern("[Ll]ang").search("Accept-Language")
+    True
+    >>> Pattern("x").search(None)
+    False
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.regex = None
+        self.literal = parse_literal(pattern)
+        if self.literal is None:
+            self.regex = re.compile(pattern)
+
+    def search(self, text):
+        """ True if 'pattern' matches anywhere in 'text' (re.search) """
+        if text is None:
+            return False
+        if self.regex is not None:
+            return self.regex.search(text) is not None
+        literal, start, end = self.literal
+        if start and end:
+            return text == literal
+        if start:
+            return text.startswith(literal)
+        if end:
+            return text.endswith(literal)
+        return literal in text
+
+    def match(self, text):
+        """ True if 'pattern' matches at the beginning of 'text' (re.match) """
+        if text is None:
+            return False
+        if self.regex is not None:
+            return self.regex.match(text) is not None
+        literal, _, end = self.literal
+        if end:
+            return text == literal
+        return text.startswith(literal)
+
+    def __repr__(self):
+        return 'Pattern(%r)' % self.pattern
+
+
+def compile_names_values(names_values):
+    """
+    Compile the 'name regex=value regex' dictionary created by split_to_dict.
+    :param names_values: Dictionary with regular expressions as keys and values
+    :return: Dictionary with Pattern keys and Pattern (or None) values
+
+    >>> compile_names_values({'Language': 'en'})
+    {Pattern('Language'): Pattern('en')}
+    >>> compile_names_values({'user': None})
+    {Pattern('user'): None}
+    """
+    return dict((Pattern(k), Pattern(v) if v else None) for k, v in names_values.iteritems())
+
+
+class Highlighter(object):
+    """ The regular expressions of split_re, compiled once. All patterns are combined
+    into one alternation, with a group each, and the text is split in a single pass.
+
+    An earlier pattern wins over a later one that overlaps it, also when the later one
+    starts further left (e.g. "ab" over "bc" in "abc"). The alternation would pick the
+    later one then, so each match is checked against the patterns before it. If one of
+    them matches inside it, or a pattern needs to see the text around the part it's
+    applied to, each pattern is looked for separately in what's left by the ones before it.
+
+    Example:
+    >>> Highlighter(["bc", "ab"]).split("abc")
+    [('a', False), ('bc', True)]
+    >>> Highlighter(["ab", "c"]).split("abcab")
+    [('ab', True), ('c', True), ('ab', True)]
+    >>> Highlighter(["x", "y"]).split("abc")
+    [('abc', False)]
+    """
+    cache = dict()
+
+    def __init__(self, patterns):
+        self.patterns = [re.compile(pattern) for pattern in patterns]
+        self.combined = None
+        # Pattern number of the group of each pattern in 'combined', and the alternation of the patterns before it
+        self.pattern_numbers = dict()
+        self.earlier = None
+        # Inline flags would apply to all of the alternation, and group numbers change in it
+        if all(compiled.flags == 0 and not BACKREFERENCE.search(compiled.pattern) for compiled in self.patterns):
+            try:
+                self.combined = re.compile('|'.join('(%s)' % pattern for pattern in patterns))
+                if not any(CONTEXT.search(pattern) for pattern in patterns):
+                    group = 1
+                    for number, compiled in enumerate(self.patterns):
+                        self.pattern_numbers[group] = number
+                        group += compiled.groups + 1
+                    self.earlier = [None] + [re.compile('|'.join('(?:%s)' % pattern for pattern in patterns[:i]))
+                                             for i in xrange(1, len(patterns))]
+            except (re.error, AssertionError):  # E.g. the same group name in two patterns, or too many groups
+                self.combined = None
+
+    @classmethod
+    def get(cls, patterns):
+        """
+        :return: The Highlighter for 'patterns', compiled the first time it's asked for
+        """
+        key = tuple(pattern for pattern in patterns if pattern)
+        highlighter = cls.cache.get(key)
+        if highlighter is None:
+            if len(cls.cache) >= HIGHLIGHTER_CACHE_SIZE:
+                cls.cache.clear()
+            highlighter = cls.cache[key] = cls(key)
+        return highlighter
+
+    def matches(self, text):
+        """ True if any pattern may match 'text' """
+        return self.combined is None or self.combined.search(text) is not None
+
+    def split(self, text):
+        if len(self.patterns) == 1:
+            return self.split_one(self.patterns[0], text)
+        if not self.patterns or not self.matches(text):
+            return [(text, False)]
+        if self.earlier is not None:
+            parts = self.split_once(text)
+            if parts is not None:
+                return parts
+        return self.split_each(text)
+
+    def split_once(self, text):
+        """
+        Split 'text' with one pass of the combined patterns.
+        :return: list of (text, matching), or None if a pattern matches inside a match of a later one
+        """
+        parts = list()
+        prev_end = 0
+        for match in self.combined.finditer(text):
+            start, end = match.span()
+            if start == end:
+                return None
+            number = self.pattern_numbers[match.lastindex]
+            if number:
+                earlier = self.earlier[number]
+                for position in xrange(start + 1, end):
+                    if earlier.match(text, position):
+                        return None
+            if start > prev_end:
+                parts.append((text[prev_end:start], False))
+            parts.append((text[start:end], True))
+            prev_end = end
+        if prev_end < len(text):
+            parts.append((text[prev_end:], False))
+        return parts
+
+    def split_each(self, text):
+        """
+        Split 'text' with each pattern in turn, in what's left by the patterns before it.
+        """
+        parts = [(text, False)]
+        for pattern in self.patterns:
+            if pattern.search(text) is None and len(parts) == 1:
+                continue
+            new_parts = list()
+            for part in parts:
+                if part[1]:
+                    new_parts.append(part)
+                else:
+                    new_parts.extend(self.split_one(pattern, part[0]))
+            parts = new_parts
+        return parts
+
+    @staticmethod
+    def split_one(pattern, text):
+        parts = list()
+        prev_end = 0
+        for match in pattern.finditer(text):
+            start, end = match.span()
+            if start > prev_end:
+                parts.append((text[prev_end:start], False))
+            parts.append((text[start:end], True))
+            prev_end = end
+        if prev_end < len(text):
+            parts.append((text[prev_end:], False))
+        return parts
+
+
 def split_re(text, patterns):
     """ Split 'text' according to the regular expressions in 'pattern'
     :param text: Text to split
@@ -22,33 +316,9 @@ def split_re(text, patterns):
     """
     if not text:
         return None
-    parts = [(text, False)]
     if not patterns:
-        return parts
-
-    for pattern in patterns:
-        if not pattern:
-            continue
-        new_parts = list()
-        for (text, matching) in parts:
-            if matching:
-                new_parts.append((text, True))
-            else:
-                res = re.finditer(pattern, text)
-                if res:
-                    positions = list()
-                    for r in res:
-                        positions.append((r.start(), r.end()))
-                    prev_end = 0
-                    for (start, end) in positions:
-                        if start > prev_end:
-                            new_parts.append((text[prev_end:start], False))
-                        new_parts.append((text[start:end], True))
-                        prev_end = end
-                    if prev_end < len(text):
-                        new_parts.append((text[prev_end:], False))
-            parts = new_parts
-    return parts
+        return [(text, False)]
+    return Highlighter.get(patterns).split(text)
 
 
 def split_to_dict(list_to_split, separator='='):